@@ -49,8 +49,7 @@ if __name__ == '__main__':
 
     #with open('pCNN-params.json') as json_file:
     #    data = json.load(json_file)
-    #    for i, n in enumerate(policy.piecePicker.parameters()):
-    #        n.value = data[i]
+    #    policy.piecePicker.set_weights(data)
 
     data = None
     with open('qtable.json') as json_file:
@@ -64,7 +63,7 @@ if __name__ == '__main__':
     start_time = time.time() 
     policy.train_piece_picker(sampler)
     with open('pCNN-params-1.json', 'w') as outfile:
-        json.dump([p.value for p in policy.piecePicker.parameters()], fp=outfile)
+        json.dump(policy.piecePicker.get_weights(), fp=outfile)
     print("Piece trained!")
 
     for p in PIECE_ORDER:
@@ -73,7 +72,7 @@ if __name__ == '__main__':
     
     for i,p in enumerate(PIECE_ORDER):
         with open(f"mCNN{i}-params-1.json", 'w') as outfile:
-            json.dump([p.value for p in policy.movePicker[i].parameters()], fp=outfile)
+            json.dump(policy.movePicker[i].get_weights(), fp=outfile)
 
     print("--- Training complete, starting test! ---")
 
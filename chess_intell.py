@@ -1,56 +1,36 @@
-import random
+import time
 import chess
 import numpy as np
-from typing import Sequence
-from numpy.lib.function_base import average
-from chess_utils import PIECE_ORDER, serialize
+from typing import Sequence, Tuple
+from chess_utils import PIECE_ORDER, serialize_batch, serialize_planes
 from conv import Conv
 from data_sampler import DataSampler
 from denselayer import DenseLayer
 from mln import MultiLayeredNetwork
 from nn_layer import NNLayer
-from node import Node
+from tensor import ReLU, Tensor
 from policy import Policy
 from qtable import QTable
 from chess import *
 from sgd import SGD
 import tqdm
 
-def ReLU(x:Node) -> Node:
-    return x.relu()
-
-def sum_nodes(nodes:Sequence[Node]) -> Node:
-    val = Node(0)
-    for node in nodes:
-        val += node
-    return val
-
-def max_index(nodes:Sequence[Node]) -> int:
-    idx = 0
-    max = float('-inf')
-    for i, node in enumerate(nodes):
-        if node.value > max:
-            max = node.value
-            idx = i
-    return idx
+def max_index(values:Tensor) -> int:
+    return int(np.argmax(values.value))
 
 class SoftMax(NNLayer):
-    def forward(self, inputs: Sequence[Node]) -> Sequence[Node]:
-        e = np.exp(inputs)
-        return e / sum_nodes(e)
+    def forward(self, inputs: Tensor) -> Tensor:
+        e = inputs.exp()
+        return e / e.sum(axis=-1, keepdims=True) # Normalize each sample in a batch on its own
 
 class Flatten(NNLayer):
     def __init__(self, n_channels:int) -> None:
         super().__init__()
         self.channels = n_channels
 
-    def forward(self, inputs: Sequence[Node]) -> Sequence[Node]:
-        segment = len(inputs) / self.channels
-        outputs = []
-        for i in range(self.channels):
-            val = sum_nodes(inputs[int(segment*i):int(segment*(i+1))])
-            outputs.append(val/Node(segment))
-        return outputs
+    def forward(self, inputs: Tensor) -> Tensor:
+        # Average each channel segment into a single value, for every sample in a batch
+        return inputs.reshape(inputs.shape[:-1] + (self.channels, -1)).mean(axis=-1)
 
 class ChessIntell(Policy):
     def __init__(self, decoratee:Policy = QTable()) -> None:
@@ -77,7 +57,7 @@ class ChessIntell(Policy):
 
     def pick_move(self, board: Board) -> Move:
         # Pass the board state to get a position of a piece that the CNN recommends moving
-        s_board = serialize(board)
+        s_board = Tensor(serialize_planes(board).reshape(-1))
         movefrom = max_index(self.piecePicker.forward(s_board))
 
         piece = board.piece_at(movefrom) # Find the on the position
@@ -97,53 +77,76 @@ class ChessIntell(Policy):
 
         return move # Return the move
 
+    def pick_moves(self, boards: Sequence[Board]) -> Sequence[Move]:
+        # Pass all the board states through the piece picker at once
+        inputs = serialize_batch(boards).reshape(len(boards), -1)
+        movefrom = np.argmax(self.piecePicker.forward(Tensor(inputs)).value, axis=-1)
+        pieces = [board.piece_at(int(square)) for board, square in zip(boards, movefrom)]
+
+        # Then pass the board states of each piece type through its move picker at once
+        moves = [None] * len(boards)
+        for cnn_index, piece_type in enumerate(PIECE_ORDER):
+            rows = [i for i, piece in enumerate(pieces) if piece is not None and piece.piece_type == piece_type]
+            if not rows:
+                continue
+            moveto = np.argmax(self.movePicker[cnn_index].forward(Tensor(inputs[rows])).value, axis=-1)
+            for i, square in zip(rows, moveto):
+                move = Move(int(movefrom[i]), int(square))
+                if move in boards[i].legal_moves:
+                    moves[i] = move
+
+        # Pass the torch to the next policy for the boards without a legal move
+        missing = [i for i, move in enumerate(moves) if move is None]
+        if missing:
+            for i, move in zip(missing, self.decoratee.pick_moves([boards[i] for i in missing])):
+                moves[i] = move
+        return moves
+
     def update(self, state: Board, action: Move, reward: float, new_state: Board) -> None:
         self.decoratee.update(state, action, reward, new_state)
 
-    def train_piece_picker(self, sampler: DataSampler):
+    def train_piece_picker(self, sampler: DataSampler, epochs:int = 100, batch:int = 64, learning_rate:float = 0.01) -> Sequence[Tuple[float, float]]:
         # Train the piece picker network
-        training_data = [sampler.SamplePiecePickerData() for _ in range(100)]
-        learning_rate = 0.01
-        optimizer = SGD(self.piecePicker.parameters(), learning_rate) # Use gradient descend to optimize weights
-        batch = 64 # The number of training data to include in each run
-        #losses = [] # The accumulated loss
-        for _ in tqdm.tqdm(range(100)):
-            loss = [] # Reset loss
-            for _ in range(batch): # Gather results from the network
-                x, y_target = random.choice(training_data) # Take random sample to avoid sorted bias
-                y = self.piecePicker.forward(x) # Get the output from the network
-
-                loss = [((y_target[i]-y[i])**2) for i in range(len(y))] # Calculate loss for each output square it
-            loss = [l/Node(batch) for l in loss] # Get the mean squared loss for the whole batch
-            
-            #losses.append(loss) # Append the losses to the statistics
-            optimizer.zero_grad() # Reset the gradient to avoid concatenated gradients
-
-            for l in loss:
-                l.backward() # Calculate the gradient using the chain rule
-
-            optimizer.step() # Adjust weights to minimize loss using the gradient
-
-    def train_move_picker(self, sampler: DataSampler, piece: chess.PieceType):
-        # Train the piece picker network
-        training_data = [sampler.SampleMovePickerData(piece) for _ in range(100)]
-        learning_rate = 0.01
-        cnn_index = PIECE_ORDER.index(piece.piece_type)
-        optimizer = SGD(self.movePicker[cnn_index].parameters(), learning_rate) # Use gradient descend to optimize weights
-        batch = 64 # The number of training data to include in each run
-        #losses = [] # The accumulated loss
-        for _ in tqdm.tqdm(range(100)):
-            loss = [] # Reset loss
-            for _ in range(batch): # Gather results from the network
-                x, y_target = random.choice(training_data) # Take random sample to avoid sorted bias
-                y = self.movePicker[cnn_index].forward(x) # Get the output from the network
-                loss = [((y_target[i]-y[i])**2) for i in range(len(y))] # Calculate loss for each output
-            loss = [l/Node(batch) for l in loss] # Get the average loss for the whole batch
-            
-            #losses.append(loss) # Append the losses to the statistics
-            optimizer.zero_grad() # Reset the gradient to avoid concatenated gradients
-
-            for l in loss:
-                l.backward() # Calculate the gradient using the chain rule
-
-            optimizer.step() # Adjust weights to minimize loss using the gradient
\ No newline at end of file
+        inputs, targets = sampler.SamplePiecePickerBatch(100)
+        return self._train(self.piecePicker, inputs, targets, epochs, batch, learning_rate)
+
+    def train_move_picker(self, sampler: DataSampler, piece: chess.PieceType, epochs:int = 100, batch:int = 64, learning_rate:float = 0.01) -> Sequence[Tuple[float, float]]:
+        # Train the move picker network for the piece type
+        inputs, targets = sampler.SampleMovePickerBatch(piece, 100)
+        cnn_index = PIECE_ORDER.index(piece)
+        return self._train(self.movePicker[cnn_index], inputs, targets, epochs, batch, learning_rate)
+
+    def _train(self, network: MultiLayeredNetwork, inputs: np.ndarray, targets: np.ndarray, epochs:int, batch:int, learning_rate:float) -> Sequence[Tuple[float, float]]:
+        """
+        Trains the network on minibatches of the training data, one forward and backward pass per batch.
+
+        inputs: The (N, 384) serialized states to train on
+        targets: The (N, 64) expected outputs for the states
+        epochs: The number of passes over the training data
+        batch: The number of training data to include in each run
+        Returns the mean loss and the number of samples per second for each epoch.
+        """
+        optimizer = SGD(network.parameters(), learning_rate) # Use gradient descend to optimize weights
+        
+        stats = [] # The loss and throughput of each epoch
+        progress = tqdm.tqdm(range(epochs))
+        for _ in progress:
+            start_time = time.time()
+            order = np.random.permutation(len(inputs)) # Shuffle to avoid sorted bias
+            total_loss = 0.0
+            for i in range(0, len(order), batch):
+                idx = order[i:i + batch]
+                y = network.forward(Tensor(inputs[idx])) # Get the output from the network for the whole batch
+
+                loss = ((Tensor(targets[idx]) - y)**2).sum()/len(idx) # Get the mean squared loss for the whole batch
+                total_loss += float(loss.value) * len(idx)
+
+                optimizer.zero_grad() # Reset the gradient to avoid concatenated gradients
+                loss.backward(release_graph=True) # Calculate the gradient using the chain rule
+                optimizer.step() # Adjust weights to minimize loss using the gradient
+
+            stats.append((total_loss / len(inputs), len(inputs) / (time.time() - start_time)))
+            progress.set_postfix(loss=stats[-1][0], samples_per_sec=round(stats[-1][1]))
+
+        print("Trained %s samples at %.0f samples/sec, final loss: %.6f" % (epochs * len(inputs), np.mean([s[1] for s in stats]), stats[-1][0]))
+        return stats
@@ -1,18 +1,140 @@
-from typing import Sequence
+import random
+from typing import Iterable, List, Sequence, Tuple
+import numpy as np
 from chess import *
 from node import Node
 
 PIECE_ORDER = [PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING] # The order of the move pickers representations
 
+def _piece_masks(board: Board) -> Sequence[int]:
+    """Returns the bitboard of every piece type in PIECE_ORDER, first for white and then for black"""
+    white, black = board.occupied_co[WHITE], board.occupied_co[BLACK]
+    masks = [board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings] # Same order as PIECE_ORDER
+    return [m & white for m in masks] + [m & black for m in masks]
+
+def _unpack(masks: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Unpacks (..., 2, 6) bitboards into (..., 6, 8, 8) planes of 1 for white, -1 for black and 0 for empty squares.
+    """
+    # Stored big endian, the first bit unpacked is square 63, so the squares come out in the order of reversed(range(64))
+    bits = np.unpackbits(masks.astype('>u8').view(np.uint8)).view(np.int8)
+    bits = bits.reshape(masks.shape[:-2] + (2, 6, 8, 8))
+    np.subtract(bits[..., 0, :, :, :], bits[..., 1, :, :, :], out=out)
+    return out
+
+def serialize_planes(board: Board, out: np.ndarray = None) -> np.ndarray:
+    """
+    Creates a (6, 8, 8) board representation straight from the bitboards, one layer for each piece.
+    White pieces are represented as 1 while black pieces are represented as -1
+    The order of the layers are determined by the PIECE_ORDER
+
+    out: A preallocated (6, 8, 8) array to fill, otherwise a new float32 array is created
+    """
+    if out is None:
+        out = np.empty((6, 8, 8), dtype=np.float32)
+    return _unpack(np.array(_piece_masks(board), dtype=np.uint64).reshape(2, 6), out)
+
+def serialize_batch(boards: Sequence[Board], out: np.ndarray = None) -> np.ndarray:
+    """
+    Serializes a batch of boards into a (N, 6, 8, 8) array, like serialize_planes
+
+    out: A preallocated (N, 6, 8, 8) array to fill in place, otherwise a new float32 array is created
+    """
+    if out is None:
+        out = np.empty((len(boards), 6, 8, 8), dtype=np.float32)
+    masks = np.array([_piece_masks(board) for board in boards], dtype=np.uint64).reshape(len(boards), 2, 6)
+    return _unpack(masks, out)
+
 def serialize(board: Board) -> Sequence[Node]:
     """
     Creates a board representation in 6 layers, one for each piece.
     White pieces are represented as 1 while black pieces are represented as -1
     The order of the layers are determined by the PIECE_ORDER
     """
-    output = []
-    for piece in PIECE_ORDER:
-        w = board.pieces(piece, WHITE)
-        b = board.pieces(piece, BLACK)
-        output.extend([Node(1) if s in w else Node(-1) if s in b else Node(0) for s in reversed(range(64))])
-    return output
\ No newline at end of file
+    return [Node(v) for v in serialize_planes(board).ravel().tolist()]
+
+def pack_move(move: Move) -> int:
+    """Packs a move into 16 bits: the from square, the to square and the promotion piece type"""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+def unpack_move(packed: int) -> Move:
+    """Restores a move packed by pack_move"""
+    return Move(packed & 0x3F, packed >> 6 & 0x3F, packed >> 12 or None)
+
+def random_legal_move(board: Board, tries: int = 8) -> Move:
+    """
+    Draws a uniformly random legal move, without generating all the legal moves.
+    A pseudo legal move is drawn uniformly from the bitboards, and kept if it doesn't leave the king in check.
+    Every legal move is drawn with the same chance, so the accepted move is uniform among the legal moves.
+    tries: The number of draws before falling back to generating all the legal moves
+    """
+    if not board.is_check(): # When in check most pseudo legal moves are illegal, so generate the evasions instead
+        us = board.occupied_co[board.turn]
+
+        # Count the target squares of the pieces from their attack masks, and list the moves of the pawns and castling
+        targets = []
+        total = 0
+        for square in scan_forward(us & ~board.pawns):
+            mask = board.attacks_mask(square) & ~us
+            if mask:
+                targets.append((square, mask))
+                total += popcount(mask)
+        others = list(board.generate_pseudo_legal_moves(from_mask=board.pawns))
+        others += board.generate_castling_moves() # Only generates castling moves that are legal
+        total += len(others)
+
+        for _ in range(tries):
+            i = random.randrange(total)
+            move = None
+            for square, mask in targets:
+                count = popcount(mask)
+                if i < count:
+                    for to_square in scan_forward(mask):
+                        if i == 0:
+                            break
+                        i -= 1
+                    move = Move(square, to_square)
+                    break
+                i -= count
+            else:
+                move = others[i]
+            if not board.is_into_check(move):
+                return move
+    return random.choice(list(board.legal_moves))
+
+def position_key(board: Board) -> Tuple[int, ...]:
+    """A cheap hashable key of the position (pieces, side to move, castling rights and en passant square), without the move counters"""
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+        board.occupied_co[WHITE], board.occupied_co[BLACK], board.turn, board.castling_rights, board.ep_square)
+
+def checking_candidates(board: Board, moves: Iterable[Move]) -> List[Move]:
+    """
+    Filters the moves down to the ones that can give check, keeping their order, without pushing any of them.
+    A move can only give check directly by landing on a square that attacks the king of the opponent, or by moving
+    away from between the king and a slider of the player (discovered check). Castling, en passant and promotions are always kept.
+    """
+    king = board.king(not board.turn)
+    if king is None:
+        return list(moves)
+    occupied = board.occupied
+    us = board.occupied_co[board.turn]
+
+    # The squares each piece type would give check from
+    diagonal = BB_DIAG_ATTACKS[king][BB_DIAG_MASKS[king] & occupied]
+    straight = BB_RANK_ATTACKS[king][BB_RANK_MASKS[king] & occupied] | BB_FILE_ATTACKS[king][BB_FILE_MASKS[king] & occupied]
+    checks = {PAWN: BB_PAWN_ATTACKS[not board.turn][king], KNIGHT: BB_KNIGHT_ATTACKS[king], BISHOP: diagonal,
+        ROOK: straight, QUEEN: diagonal | straight, KING: BB_EMPTY}
+
+    # The pieces of the player that are the only piece between the king and one of the player's sliders
+    snipers = (BB_DIAG_ATTACKS[king][0] & (board.bishops | board.queens)) | \
+        ((BB_RANK_ATTACKS[king][0] | BB_FILE_ATTACKS[king][0]) & (board.rooks | board.queens))
+    blockers = BB_EMPTY
+    for sniper in scan_forward(snipers & us):
+        between_mask = between(king, sniper) & occupied
+        if popcount(between_mask) == 1:
+            blockers |= between_mask & us
+
+    return [move for move in moves
+        if move.promotion or BB_SQUARES[move.from_square] & blockers or
+        BB_SQUARES[move.to_square] & checks[board.piece_type_at(move.from_square)] or
+        board.is_castling(move) or board.is_en_passant(move)]
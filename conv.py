@@ -1,9 +1,9 @@
 from math import prod
-import time
 from typing import Sequence
+import numpy as np
 from initializer import *
 from nn_layer import NNLayer
-from node import Node
+from tensor import Tensor, as_tensor
 
 """
 A basic convolutional neural network, implemented by Thomas Volden.
@@ -26,58 +26,103 @@ class Conv(NNLayer):
         self.input_shape = input_shape
         self.weights = initializer.init_weights_flat(pow(filter_size,2) * input_shape[2] * n_filters)
         self.bias = initializer.init_bias(n_filters)
+        self.weight_index = self._weight_index()
+        self.patch_index = self._patch_index()
 
-    def parameters(self) -> Sequence[Node]:
-      """Returns all the vars of the layer (weights + biases) as a single flat list"""
-      output = [w for w in self.weights]
-      output.extend(self.bias)
-      return output
+    def parameters(self) -> Sequence[Tensor]:
+      """Returns all the vars of the layer (weights + biases) as a flat list of tensors"""
+      return [self.weights, self.bias]
 
-    def forward(self, inputs: Sequence[Node]) -> Sequence[Node]:
-        """ 
-        inputs: input values from the three dimentional value map of width, height and channel.
+    def _weight_index(self) -> np.ndarray:
+        """
+        Maps every filter bank, channel, row and column of the filters to a position in the flat weight vector.
 
-        Check to see if the lenght of inputs are equal to the product of the defined shape (x*y*z)
-        
-        The strider is automatically set to 1,1 since I don't need to change it.
+        The mapping mirrors the offsets of the original scalar implementation, so saved parameters keep producing the same outputs.
         """
-        assert prod(self.input_shape) == len(inputs), "The input must meet the defined shape"
-        output = []
-        steps_x = self.input_shape[0] - self.filter_size + 1 # Calculate max number of moves to the right
-        steps_y = self.input_shape[1] - self.filter_size + 1 # Calculate max number of moves to the bottom
         sqr_filter = pow(self.filter_size,2)
-
-        for f in range(self.filters): # For each filter bank
-            # We going to stride through the whole input (width, height) and all channelse to produce a 2D feature map.
+        index = np.zeros((self.filters, self.input_shape[2], self.filter_size, self.filter_size), dtype=np.int64)
+        for f in range(self.filters):
             filter = f * (sqr_filter + self.input_shape[2]) # Skip whole filter banks
+            for k in range(self.input_shape[2]):
+                filter_chan = k * sqr_filter # Skip a height and width layer for each channel
+                for i in range(self.filter_size):
+                    for j in range(self.filter_size):
+                        filter_row = j * self.filter_size # Skip a filter width for each row
+                        index[f, k, i, j] = filter + filter_chan + filter_row + j
+        return index
+
+    def _patch_index(self) -> np.ndarray:
+        """
+        Maps every output position and filter entry (channel, row, column) to a position in the flat input.
 
-            for y in range(steps_y): # For each move to the bottom
-                for x in range(steps_x): # For each move to the right
-                    val = Node(0)
-                    
-                    #start_time = time.time() 
-                    # Append j,i and k values from filter bank to x,y and all channels
+        Gathering the input with this index turns the board into a patch matrix (im2col), so the whole layer is one matrix multiply.
+        """
+        steps_x = self.input_shape[0] - self.filter_size + 1 # Calculate max number of moves to the right
+        steps_y = self.input_shape[1] - self.filter_size + 1 # Calculate max number of moves to the bottom
+        index = np.zeros((steps_y, steps_x, self.input_shape[2], self.filter_size, self.filter_size), dtype=np.int64)
+        for y in range(steps_y): # For each move to the bottom
+            for x in range(steps_x): # For each move to the right
+                for k in range(self.input_shape[2]):
+                    chan = k * self.input_shape[0] * self.input_shape[1] # Skip input width and height for each channel
                     for i in range(self.filter_size):
                         row = (i + y) * self.input_shape[0] # Skip input width plus stride y offset for each row
                         for j in range(self.filter_size):
-                            filter_row = j * self.filter_size # Skip a filter width for each row
-                            col = x + j # Skip stride x offset for each column
-                            # For each width and height in the input, we go through all channels, apply weights and append the result
-                            for k in range(self.input_shape[2]):
-                                filter_chan = k * sqr_filter # Skip a height and width layer for each channel
-                                chan = k * self.input_shape[0] * self.input_shape[1] # Skip input width and height for each channel
-                                val += self.weights[filter + filter_chan + filter_row + j] * inputs[chan + row + col] # Apply weight
-                    
-                    #if (time.time() - start_time) > 0.00001:
-                    #    print(f"x:{x}, y:{y}, f:{f}")
-                    #    print("## TIME %s sec" % ((time.time() - start_time)))
-
-                    # Apply the filter bank bias and parse it through a non-lineary activation function
-                    output.append(self.act_fn(val + self.bias[f]))
-
-            
+                            index[y, x, k, i, j] = chan + row + x + j # Skip stride x offset for each column
+        return index.reshape(steps_y * steps_x, -1)
+
+    def forward(self, inputs: Tensor) -> Tensor:
+        """ 
+        inputs: input values from the three dimentional value map of width, height and channel.
+            Either a single flat input or a batch of them (N, x*y*z).
+
+        Check to see if the lenght of inputs are equal to the product of the defined shape (x*y*z)
+        
+        The strider is automatically set to 1,1 since I don't need to change it.
+        """
+        inputs = as_tensor(inputs)
+        assert prod(self.input_shape) == inputs.shape[-1], "The input must meet the defined shape"
+
+        # Apply the filter banks and bias and parse it through a non-lineary activation function
+        output = self.act_fn(conv2d(inputs, self.weights, self.bias, self.weight_index, self.patch_index))
 
         # The output size should be equal to (x - filter_size + 1) * (y - filter_size + 1) * filters
-        assert prod([s - self.filter_size + 1 for s in self.input_shape[:2]]) * self.filters == len(output), "The output must meet the reduced shapes"
+        assert prod([s - self.filter_size + 1 for s in self.input_shape[:2]]) * self.filters == output.shape[-1], "The output must meet the reduced shapes"
+
+        return output
+
+def conv2d(inputs: Tensor, weights: Tensor, bias: Tensor, weight_index: np.ndarray, patch_index: np.ndarray) -> Tensor:
+    """
+    Convolves a (batch of) flat input(s) with one matrix multiply and returns the feature maps, one filter bank after the other.
+
+    weight_index: The (filters, channels, rows, columns) position of every filter entry in the flat weights
+    patch_index: The (positions, channels * rows * columns) position of every patch entry in the flat input
+    """
+    x = inputs.value.reshape(-1, inputs.shape[-1]) # A single input is a batch of one
+    n, positions = x.shape[0], patch_index.shape[0]
+    filters = weight_index.shape[0]
+    w_index = weight_index.reshape(filters, -1)
+
+    cols = x[:, patch_index].reshape(n * positions, -1) # Patch matrix: (batch * positions, channels * rows * columns)
+    w = weights.value[w_index] # Filter matrix: (filters, channels * rows * columns)
+    out = (cols @ w.T).reshape(n, positions, filters) + bias.value
+    out = out.transpose(0, 2, 1).reshape(inputs.shape[:-1] + (filters * positions,)) # Filter bank major, like the input
+
+    def d_out(df):
+        # Bring the upstream gradient back to the (batch * positions, filters) layout of the matrix multiply
+        return df.reshape(n, filters, positions).transpose(0, 2, 1).reshape(n * positions, filters)
+
+    def grad_weights(df):
+        dw = d_out(df).T @ cols # The gradient for every entry of the filter matrix
+        # Several filter entries share a weight, so we accumulate them into the flat weights
+        return np.bincount(w_index.ravel(), weights=dw.ravel(), minlength=weights.value.size)
+
+    def grad_bias(df):
+        return d_out(df).sum(axis=0)
+
+    def grad_inputs(df):
+        dcols = (d_out(df) @ w).reshape(n, -1) # The gradient for every entry of the patch matrix
+        # Patches overlap, so we accumulate them into the flat input of each sample in the batch
+        index = (patch_index.reshape(1, -1) + np.arange(n).reshape(-1, 1) * x.shape[1]).ravel()
+        return np.bincount(index, weights=dcols.ravel(), minlength=x.size).reshape(inputs.shape)
 
-        return output 
\ No newline at end of file
+    return Tensor(out, [(weights, grad_weights), (bias, grad_bias), (inputs, grad_inputs)])
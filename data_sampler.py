@@ -1,80 +1,100 @@
-from math import exp
-from typing import Dict, Sequence, Tuple
-from node import Node, square
-import random
+from typing import Dict, Iterator, Sequence, Tuple, Union
+import numpy as np
 import chess
 import chess_utils
+from chess_utils import PIECE_ORDER, unpack_move
+from qtable_binary import BinaryQTable
 
 class DataSampler:
-    def __init__(self, data: Dict[str, Dict[str, float]]) -> None:
+    def __init__(self, data: Union[Dict[str, Dict[str, float]], BinaryQTable]) -> None:
         """
-        data: Q-Table sample data
+        data: Q-Table sample data, either FEN keyed (like qtable.json) or a binary Q-Table file with positions
+
+        The Q-Table is preprocessed once into dense arrays, so sampling is just indexing into them.
         """
         self.data = data
+        self._preprocess()
 
-    def SamplePiecePickerData(self) -> Tuple[Sequence[Node], Sequence[Node]]:
+    def _preprocess(self) -> None:
         """
-        Sample random data from the Q-Table to be used as training data for a piece picker network
+        Serializes every state and aggregates the expected outputs of the piece picker and all the move pickers
         """
-        state = random.choice(list(self.data)) # Select a random state
-        board = chess.Board(state)# Restore the state from the FEN notation
-        input = chess_utils.serialize(board) # Turn the state into 6 layered representation
-        
-        # Find move from squares
-        squares = {}
-        for action in self.data[state]:
-            movefrom = chess.Move.from_uci(action).from_square
-            if movefrom not in squares:
-                squares[movefrom] = [self.data[state][action], 1]
-            else:
-                squares[movefrom][0] += self.data[state][action]
-                squares[movefrom][1] += 1
-        
-        # Now lets take the average value for each square
-        expected_output = [] # Make a 8x8 chess board representing piece picker values
-        for i in range(64):
-            if i in squares:
-                expected_output.append(Node(squares[i][0]/squares[i][1]))
-            else:
-                expected_output.append(Node(0))
+        entries = list(self._entries())
+        n = len(entries)
+        boards = [chess.Board(state) for state, _, _ in entries] # Restore the states from the FEN notation
+
+        # Turn the states into 6 layered representations, one flat row per state
+        self.inputs = np.empty((n, 6 * 64), dtype=np.float32)
+        chess_utils.serialize_batch(boards, out=self.inputs.reshape(n, 6, 8, 8))
 
-        return input, expected_output
+        # 8x8 chess boards representing the piece picker and move picker values of each state
+        self.piece_targets = np.zeros((n, 64))
+        self.move_targets = np.zeros((len(PIECE_ORDER), n, 64))
+        eligible = [[] for _ in PIECE_ORDER] # The states that contains a move for each piece type
 
-    def SampleMovePickerData(self, piece: chess.PieceType) -> Tuple[Sequence[Node], Sequence[Node]]:
+        for i, ((_, moves, values), board) in enumerate(zip(entries, boards)):
+            movefrom = np.array([m.from_square for m in moves], dtype=np.int64)
+            moveto = np.array([m.to_square for m in moves], dtype=np.int64)
+            pieces = np.array([board.piece_type_at(m.from_square) for m in moves], dtype=np.int64)
+
+            # Take the average value for each square, since several moves can start from the same square
+            self.piece_targets[i] = _average(movefrom, values)
+
+            # The same piece type potentially can pick the same place to moveto
+            # For example two knights able to move to the same spot to check the king and snatch the queen.
+            for p, piece in enumerate(PIECE_ORDER):
+                mask = pieces == piece
+                if mask.any():
+                    self.move_targets[p, i] = _average(moveto[mask], values[mask])
+                    eligible[p].append(i)
+
+        self.eligible = [np.array(e, dtype=np.int64) for e in eligible]
+
+    def _entries(self) -> Iterator[Tuple[str, Sequence[chess.Move], np.ndarray]]:
         """
-        Sample random data from the Q-Table to be used as training data for a move picker network
+        Iterates over the FEN, the moves and the values of every state in the Q-Table
         """
-        found = False 
-        while not found: # Repeat until we find a state that contains the piece
+        if isinstance(self.data, BinaryQTable):
+            assert self.data.has_positions(), "The binary Q-Table must store positions to restore the states"
+            for i in range(len(self.data)):
+                moves, values = self.data.actions(i)
+                yield self.data.position(i), [unpack_move(m) for m in moves.tolist()], np.asarray(values, dtype=float)
+        else:
+            for state, actions in self.data.items():
+                yield state, [chess.Move.from_uci(action) for action in actions], np.fromiter(actions.values(), dtype=float, count=len(actions))
 
-            state = random.choice(list(self.data)) # Select a random state
-            board = chess.Board(state) # Restore the state from the FEN notation
-            input = chess_utils.serialize(board) # Turn the state into 6 layered representation
-            expected_output = [Node(0) for _ in range(64)] # Create an 8x8 chess board with all zeros
-            
-            # Update the values in the chess board with the values in our Q-Table
-            # We have to store values in a temporary dictionary, since the same piece type potentially can pick the same place to moveto
-            # For example two knights able to move to the same spot to check the king and snatch the queen.
-            squares = {}
-            for action in self.data[state]:
-                if board.piece_at(move.from_square).piece_type != piece:
-                    continue # Don't update for other piece types
+    def SamplePiecePickerBatch(self, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample n random states as (n, 384) inputs and (n, 64) expected outputs for a piece picker network
+        """
+        idx = np.random.randint(len(self.inputs), size=n)
+        return self.inputs[idx], self.piece_targets[idx]
+
+    def SampleMovePickerBatch(self, piece: chess.PieceType, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample n random states containing a move for the piece, as (n, 384) inputs and (n, 64) expected outputs for a move picker network
+        """
+        p = PIECE_ORDER.index(piece)
+        assert len(self.eligible[p]) > 0, "The Q-Table has no moves for the piece"
+        idx = self.eligible[p][np.random.randint(len(self.eligible[p]), size=n)]
+        return self.inputs[idx], self.move_targets[p, idx]
 
-                found = True # Found a move to match the piece, so no need to repeat for a new state
+    def SamplePiecePickerData(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample random data from the Q-Table to be used as training data for a piece picker network
+        """
+        x, y = self.SamplePiecePickerBatch(1)
+        return x[0], y[0]
+
+    def SampleMovePickerData(self, piece: chess.PieceType) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample random data from the Q-Table to be used as training data for a move picker network
+        """
+        x, y = self.SampleMovePickerBatch(piece, 1)
+        return x[0], y[0]
 
-                moveto = chess.Move.from_uci(action).to_square
-                if moveto not in squares:
-                    squares[moveto] = (self.data[state][action], 1)
-                else:
-                    squares[moveto][0] += self.data[state][action]
-                    squares[moveto][1] += 1
-            
-            # Now lets take the average value for each square
-            expected_output = [] # Make a 8x8 chess board representing piece picker values
-            for i in range(64):
-                if i in squares:
-                    expected_output.append(Node(squares[i][0]/squares[i][1]))
-                else:
-                    expected_output.append(Node(0))
-    
-        return input, expected_output
\ No newline at end of file
+def _average(squares: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Averages the values landing on each of the 64 squares, squares without values are 0"""
+    sums = np.bincount(squares, weights=values, minlength=64)
+    counts = np.bincount(squares, minlength=64)
+    return np.divide(sums, counts, out=np.zeros(64), where=counts > 0)
@@ -1,6 +1,7 @@
+from typing import Sequence
 from initializer import *
 from nn_layer import NNLayer
-from node import Node
+from tensor import ACTIVATION_DERIVATIVES, Tensor, as_tensor
 
 class DenseLayer(NNLayer):
     def __init__(self, n_in: int, n_out: int, act_fn, initializer: Initializer = NormalInitializer()):
@@ -19,27 +20,49 @@ class DenseLayer(NNLayer):
     def __repr__(self):    
         return 'Weights: ' + repr(self.weights) + ' Biases: ' + repr(self.bias)
 
-    def parameters(self) -> Sequence[Node]:
-      """Returns all the vars of the layer (weights + biases) as a single flat list"""
-      output = []
-      for i in range(self.n_in):
-        for j in range(self.n_out):
-          output.append(self.weights[i][j])
-      output.extend(self.bias)
-      return output
+    def parameters(self) -> Sequence[Tensor]:
+      """Returns all the vars of the layer (weights + biases) as a flat list of tensors"""
+      return [self.weights, self.bias]
       
-    def forward(self, inputs: Sequence[Node]) -> Sequence[Node]:
+    def forward(self, inputs: Tensor) -> Tensor:
         """ 
-        inputs: A n_in length vector of Var's corresponding to the previous layer outputs or the data if it's the first layer.
+        inputs: A n_in length vector corresponding to the previous layer outputs or the data if it's the first layer.
+            A batch of them can be passed as a (N, n_in) matrix.
 
         Computes the forward pass of the dense layer: For each output neuron, j, it computes: act_fn(weights[i][j]*inputs[i] + bias[j])
-        Returns a vector of Vars that is n_out long.
+        Returns a vector that is n_out long, or a (N, n_out) matrix for a batch.
         """
-        assert len(self.weights) == len(inputs), "weights and inputs must match in first dimension"        
-        output = []
-        for j in range(self.n_out):
-          val = Node(0)
-          for i in range(len(inputs)):
-            val += self.weights[i][j] * inputs[i]
-          output.append(self.act_fn(val + self.bias[j]))
-        return output
\ No newline at end of file
+        inputs = as_tensor(inputs)
+        assert len(self.weights) == inputs.shape[-1], "weights and inputs must match in first dimension"
+        if self.act_fn in ACTIVATION_DERIVATIVES:
+            return dense(inputs, self.weights, self.bias, self.act_fn)
+        return self.act_fn(dense(inputs, self.weights, self.bias)) # Unknown activations get their own graph
+
+def dense(inputs: Tensor, weights: Tensor, bias: Tensor, act_fn = None) -> Tensor:
+    """
+    Computes act_fn(inputs @ weights + bias) for a (batch of) input(s) with one matrix multiply.
+
+    act_fn: An activation from ACTIVATION_DERIVATIVES which is fused into the same operation, or None for no activation
+    """
+    x = inputs.value.reshape(-1, inputs.shape[-1]) # A single input is a batch of one
+    out = x @ weights.value + bias.value
+    if act_fn is not None:
+        out = act_fn(Tensor(out)).value
+    derivative = ACTIVATION_DERIVATIVES[act_fn](out) if act_fn is not None else None
+    out = out.reshape(inputs.shape[:-1] + (weights.shape[1],))
+
+    def d_out(df):
+        # The upstream gradient through the activation, as a (batch, n_out) matrix
+        df = df.reshape(-1, weights.shape[1])
+        return df if derivative is None else df * derivative
+
+    def grad_weights(df):
+        return x.T @ d_out(df)
+
+    def grad_bias(df):
+        return d_out(df).sum(axis=0)
+
+    def grad_inputs(df):
+        return (d_out(df) @ weights.value.T).reshape(inputs.shape)
+
+    return Tensor(out, [(weights, grad_weights), (bias, grad_bias), (inputs, grad_inputs)])
\ No newline at end of file
@@ -4,7 +4,7 @@ from chess_utils import PIECE_ORDER
 from data_sampler import DataSampler
 from mcts import DecisiveMovePolicy, MonteCarloTreeSearch
 from policy import Policy
-from qtable import QTable
+from qtable import QTable, ZobristQTable
 import numpy as np
 import json
 import time
@@ -42,7 +42,7 @@ def e1_mate_in_one_MCTS():
         policy = DecisiveMovePolicy()
         time_budget = 1
         c = 0.3
-        mcts = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, parallel=parallel, policy=policy)
+        mcts = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, parallel=parallel, policy=policy, solver=True)
         players = (mcts.choose, mcts.choose) # Play against it self
 
         # We set turn limit to one, since the MCTS should be able to defeat the opponent in one move
@@ -75,6 +75,7 @@ def e1_mate_in_one_MCTS():
         else:
             print("Max turns reached!")
 
+        mcts.close() # Stop the worker processes, a new search is set up for the next try
         wanna_play = input("Wanna try again? [Yes/No] (default=No): ").lower() in ["yes", "y"]
 
 def e2_mate_in_two_MCTS_QLearning():
@@ -109,7 +110,7 @@ def e2_mate_in_two_MCTS_QLearning():
 
         # Setup a MCTS from experiment1 to play the opponent
         opponent = MonteCarloTreeSearch(exploration_weight=exploration, time_budget=1, policy=DecisiveMovePolicy())
-        mcts_q = MonteCarloTreeSearch(exploration_weight=exploration, time_budget=5, parallel=True, policy=policy)
+        mcts_q = MonteCarloTreeSearch(exploration_weight=exploration, time_budget=5, parallel=True, policy=policy, solver=True)
         
         #######################
         # Game configurations #
@@ -146,6 +147,7 @@ def e2_mate_in_two_MCTS_QLearning():
         print()
         print(f">>> {episode+1}: White: {wins[0]}/{games}, Black: {wins[1]}/{games}")
         rewards.append(wins[0])
+        mcts_q.close() # Stop the worker processes, a new search is set up for the next episode
 
     print("Rewards over episodes:")
     print(rewards)
@@ -157,7 +159,7 @@ def e2_mate_in_two_MCTS_QLearning():
 
     # Setup a MCTS from experiment1 to play the opponent
     opponent = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=1, policy=DecisiveMovePolicy())
-    mcts_q = MonteCarloTreeSearch(exploration_weight=exploration, time_budget=time_budget, parallel=True, policy=policy)
+    mcts_q = MonteCarloTreeSearch(exploration_weight=exploration, time_budget=time_budget, parallel=True, policy=policy, solver=True)
     
     #######################
     # Game configurations #
@@ -193,6 +195,7 @@ def e2_mate_in_two_MCTS_QLearning():
     
     print()
     print(f">>> Test result: White: {wins[0]}/{games}, Black: {wins[1]}/{games}")
+    mcts_q.close() # Stop the worker processes, the games are over
 
     save = input("Want to save Q-Table? [Yes/No] (default=No): ")
     if save.lower() in ["yes", "y"]:
@@ -235,7 +238,7 @@ def e3_mate_in_two_MCTS_DQN():
 
     # Save the weights for the piece picker
     with open('pCNN-params-1.json', 'w') as outfile:
-        json.dump([p.value for p in policy.piecePicker.parameters()], fp=outfile)
+        json.dump(policy.piecePicker.get_weights(), fp=outfile)
     print("Piece trained!")
 
     # For each piece type, call the trainer for each of the 6 movement pickers
@@ -245,7 +248,7 @@ def e3_mate_in_two_MCTS_DQN():
     
     for i,p in enumerate(PIECE_ORDER):
         with open(f"mCNN{i}-params-1.json", 'w') as outfile:
-            json.dump([p.value for p in policy.movePicker[i].parameters()], fp=outfile)
+            json.dump(policy.movePicker[i].get_weights(), fp=outfile)
 
     print("--- Training complete, starting test! ---")
 
@@ -255,7 +258,7 @@ def e3_mate_in_two_MCTS_DQN():
 
     # Setup a MCTS from experiment1 to play the opponent
     opponent = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=1, policy=DecisiveMovePolicy())
-    mcts_q = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, parallel=True, policy=policy)
+    mcts_q = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, parallel=True, policy=policy, solver=True)
     
     #######################
     # Game configurations #
@@ -291,6 +294,7 @@ def e3_mate_in_two_MCTS_DQN():
     
     print()
     print(f">>> Test result: White: {wins[0]}/{games}, Black: {wins[1]}/{games}")
+    mcts_q.close() # Stop the worker processes, the games are over
 
     save = input("Want to save Q-Table? [Yes/No] (default=No): ")
     if save.lower() in ["yes", "y"]:
@@ -307,9 +311,9 @@ def play_chess():
     policy = DecisiveMovePolicy()
     q = input("May the Monte Carlo Tree search use QTable lookups? [Yes/No] (default=No): ")
     if q.lower() in ["yes", "y"]:
-        policy = QTable(ε=0.3)
+        policy = ZobristQTable(ε=0.3)
         with open('qtable.json') as json_file:
-            policy.table = json.load(json_file)
+            policy.load_fen_table(json.load(json_file))
 
     time_budget = 30
     tb = input(f"Time budget to train [seconds] (default={time_budget}): ")
@@ -342,6 +346,7 @@ def play_chess():
         print(board)
         turn += player # Increment the turn counter when player 2 has played
 
+    mcts.close() # Stop the worker processes, the game is over
     print_moves(chess.Board.starting_fen, board)
 
     # Check win conditions
@@ -350,9 +355,41 @@ def play_chess():
     elif board.is_game_over():
         print(f"Player {player + 1} wins!")
 
+def e4_tree_parallel_speedup():
+    print("Compare the playouts per second of the tree parallel MCTS (with virtual loss) against the serial MCTS on the mate in two puzzle.")
+    time_budget = 10
+    tb = input(f"Time budget of each search [seconds] (default={time_budget}): ")
+    if tb.isnumeric() and int(tb) > 0:
+        time_budget = int(tb)
+
+    def playout_rate(mcts: MonteCarloTreeSearch) -> float:
+        mcts.choose(chess.Board(mate2_puzzle)) # The first search starts the worker processes, so measure the second one
+        board = chess.Board(mate2_puzzle)
+        start_time = time.time()
+        move = mcts.choose(board)
+        rate = mcts.stats.get_explores(mcts.root.index) / (time.time() - start_time)
+        print(f"Chose {board.san(move)} after {rate:.1f} playouts per second")
+        mcts.close()
+        return rate
+
+    print("## Serial ##")
+    serial = playout_rate(MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, policy=DecisiveMovePolicy(), reuse_tree=False))
+
+    speedups = []
+    for cores in [1, 2, 4, 8]:
+        print(f"## Tree parallel, {cores} cores ##")
+        mcts = MonteCarloTreeSearch(exploration_weight=0.3, time_budget=time_budget, policy=DecisiveMovePolicy(), reuse_tree=False,
+            parallel=True, processes=cores, in_flight=4 * cores, virtual_loss=1)
+        speedups.append((cores, playout_rate(mcts) / serial))
+
+    print("Speedup against the serial search:")
+    for cores, speedup in speedups:
+        print(f"{cores} cores: {speedup:.2f}x")
+
 experiment_list = [
     ("Solve a mate in one puzzle with a MCTS algorithm.", e1_mate_in_one_MCTS),
     ("Solve a mate in two puzzle with a MCTS asssisted by Q-Learning.", e2_mate_in_two_MCTS_QLearning),
     ("Train and solve a mate in two puzzle using a MCTS assisted by DQN (takes months to run)", e3_mate_in_two_MCTS_DQN),
-    ("Play chess against a computer", play_chess)
+    ("Play chess against a computer", play_chess),
+    ("Measure the speedup of a tree parallel MCTS on a mate in two puzzle", e4_tree_parallel_speedup)
 ]
\ No newline at end of file
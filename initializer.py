@@ -1,16 +1,15 @@
-from typing import Sequence
-from node import Node
-import random
+from tensor import Tensor
+import numpy as np
 
 class Initializer:
 
-  def init_weights(self, n_in, n_out) -> Sequence[Sequence[Node]]:    
+  def init_weights(self, n_in, n_out) -> Tensor:    
     raise NotImplementedError
 
-  def init_weights_flat(self, n_in):
+  def init_weights_flat(self, n_in) -> Tensor:
     raise NotImplementedError
 
-  def init_bias(self, n_out) -> Sequence[Node]:
+  def init_bias(self, n_out) -> Tensor:
     raise NotImplementedError
 
 
@@ -21,10 +20,10 @@ class NormalInitializer(Initializer):
     self.std = std
 
   def init_weights(self, n_in, n_out):
-    return [[Node(random.gauss(self.mean, self.std)) for _ in range(n_out)] for _ in range(n_in)]
+    return Tensor(np.random.normal(self.mean, self.std, (n_in, n_out)))
 
   def init_weights_flat(self, n_in):
-    return [Node(random.gauss(self.mean, self.std)) for _ in range(n_in)]
+    return Tensor(np.random.normal(self.mean, self.std, n_in))
 
   def init_bias(self, n_out):
-    return [Node(0.0) for _ in range(n_out)]
\ No newline at end of file
+    return Tensor(np.zeros(n_out))
@@ -1,165 +1,605 @@
 # Created by Thomas Volden
+import functools
 import math
+import pickle
+import queue
 import re
 import time
-from typing import Hashable, Sequence, Tuple
+from typing import Callable, Dict, Hashable, List, Sequence, Tuple
+import numpy as np
 import chess
+import chess.polyglot
 import random
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Barrier, Pool, cpu_count
 import os
+from chess_utils import checking_candidates, pack_move, position_key, random_legal_move, unpack_move
+from evaluation import MaterialEvaluator
 from policy import Policy
-from tree import TreeNode
+from tree import TranspositionTable, TreeNode, TreeStats
 
 class RandomPolicy(Policy):
     def pick_move(self, board: chess.Board) -> chess.Move:
-        return random.choice([m for m in board.legal_moves])
+        return random_legal_move(board)
 
 class DecisiveMovePolicy(Policy):
+    def __init__(self, cache_size:int = 1 << 16) -> None:
+        """
+        cache_size: The number of positions to remember the mating move of (or that there is none). The cache is emptied
+            when it is full, and at the start of every search.
+        """
+        self.cache_size = cache_size
+        self.cache:Dict[Hashable, chess.Move] = {}
+
+    def __getstate__(self):
+        # Don't send the cache to other processes, each process builds its own
+        state = self.__dict__.copy()
+        state['cache'] = {}
+        return state
+
+    def start_search(self) -> None:
+        self.cache.clear()
+
     def pick_move(self, board: chess.Board) -> chess.Move:
-        moves = []
-        for move in board.legal_moves:
+        key = position_key(board)
+        if key in self.cache:
+            mate = self.cache[key]
+            return mate if mate is not None else random_legal_move(board)
+
+        # Only a move that gives check can mate, so only those are pushed to see if the opponent is mated
+        moves = list(board.legal_moves)
+        mate = None
+        for move in checking_candidates(board, moves):
             board.push(move)
             if board.is_checkmate():
-                board.pop()
-                return move
+                mate = move
             board.pop()
-            moves.append(move)
+            if mate is not None:
+                break
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = mate
+        return mate if mate is not None else random.choice(moves)
+
+def _reward(board: chess.Board, player: chess.Color) -> float:
+    return _outcome_reward(board.outcome(), player)
+
+def _outcome_reward(outcome: chess.Outcome, player: chess.Color) -> float:
+    # Return 0.5 if it's a draw, otherwise return 1 if current player won or 0 if other player won.
+    return 0.5 if outcome.termination == chess.Termination.STALEMATE else 1 if outcome.winner == player else 0
+
+def simulate(board: chess.Board, policy: Policy, player: chess.Color, depth:int = None) -> float:
+    """
+    Returns the reward for the player of a simulation (to completion) of the board state, following the policy
+    depth: The maximal number of moves to play, after which the position is scored by a static evaluation. None = no limit
+    """
+    evaluator = MaterialEvaluator(board) if depth is not None else None
+    # Run until we hit a terminal state
+    while not board.is_game_over():
+        if evaluator is not None:
+            if depth == 0:
+                return evaluator.score(board, player)
+            depth -= 1
+            move = policy.pick_move(board)
+            evaluator.push(board, move)
+            board.push(move)
+        else:
+            board.push(policy.pick_move(board))
+    return _reward(board, player)
+
+def simulate_batch(boards: Sequence[chess.Board], policy: Policy, player: chess.Color, depth:int = None) -> Sequence[float]:
+    """
+    Simulates all the boards side by side, so the policy picks the next move of every unfinished simulation in one batch
+    depth: The maximal number of moves to play, after which the positions are scored by a static evaluation. None = no limit
+    """
+    evaluators = [MaterialEvaluator(board) for board in boards] if depth is not None else None
+    active = [i for i, board in enumerate(boards) if not board.is_game_over()]
+    while active and depth != 0:
+        for i, move in zip(active, policy.pick_moves([boards[i] for i in active])):
+            if evaluators is not None:
+                evaluators[i].push(boards[i], move)
+            boards[i].push(move)
+        active = [i for i in active if not boards[i].is_game_over()]
+        depth = depth - 1 if depth is not None else None
+    return [evaluators[i].score(board, player) if not board.is_game_over() else _reward(board, player) for i, board in enumerate(boards)]
+
+class BatchEvaluator:
+    def __init__(self, policy: Policy, player: chess.Color, batch_size:int = 16, max_wait:float = 0.01, depth:int = None) -> None:
+        """
+        Collects the leaves selected by a search, and plays them out together once the batch is full.
+        batch_size: The number of leaves to collect before they are played out
+        max_wait: The maximal time in seconds the first leaf of a batch waits for the batch to fill up
+        depth: The maximal number of moves of a playout, see simulate
+        """
+        self.policy = policy
+        self.player = player
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.depth = depth
+        self.pending:List[Tuple[chess.Board, Callable[[float], None]]] = []
+        self.first = 0 # The time the first leaf of the batch was added
+
+    def add(self, board: chess.Board, callback: Callable[[float], None]):
+        "Queues the board for a playout, the callback receives the reward"
+        if not self.pending:
+            self.first = time.time()
+        self.pending.append((board, callback))
+
+    def ready(self) -> bool:
+        return len(self.pending) >= self.batch_size or (len(self.pending) > 0 and time.time() - self.first >= self.max_wait)
 
-        return random.choice(moves)
+    def run(self):
+        "Plays out the queued boards, and hands each reward back to the search"
+        pending, self.pending = self.pending, []
+        values = simulate_batch([board for board, _ in pending], self.policy, self.player, self.depth)
+        for (_, callback), value in zip(pending, values):
+            callback(value)
+
+_worker_policy: Policy = None # The policy installed in a worker process
+_worker_barrier: Barrier = None # Shared by the workers of a pool, so a refresh reaches every one of them
+
+def _init_worker(policy: Policy, barrier: Barrier):
+    """
+    Runs once in each worker and installs the policy, so the tasks only have to carry positions.
+    Receiving the policy while the worker is spawned lets it set up what can't be sent with a task, like locks.
+    """
+    global _worker_policy, _worker_barrier
+    _worker_policy = policy
+    _worker_barrier = barrier
+
+def _worker_refresh(policy: bytes):
+    """
+    Installs a new state of the policy, pickled once by the search.
+    The worker waits until all the workers have their refresh, so no worker takes two of them.
+    """
+    global _worker_policy
+    _worker_policy = pickle.loads(policy)
+    _worker_barrier.wait()
+
+def _worker_simulate(i:int, fen:str, action:int, player:chess.Color, depth:int = None) -> Tuple[int, float]:
+    """
+    Plays out a position in a worker.
+    fen: The position before the last move of the path, or the position to play out if there's no move
+    action: The packed last move of the path, or None
+    """
+    board = chess.Board(fen)
+    if action is None:
+        return i, simulate(board, _worker_policy, player, depth)
+    parent = board.copy(stack=False)
+    board.push(unpack_move(action))
+    value = simulate(board.copy(stack=False), _worker_policy, player, depth)
+    if _worker_policy.shared:
+        _worker_policy.update(parent, unpack_move(action), value, board) # Update the shared policy straight from the worker
+    return i, value
+
+def _worker_playout(fen:str, player:chess.Color, depth:int = None) -> float:
+    return simulate(chess.Board(fen), _worker_policy, player, depth)
+
+def _worker_search(seed:int, fen:str, moves:Sequence[int], options:dict) -> Tuple[Sequence[int], Sequence[int], Sequence[float], Sequence[int], int]:
+    """
+    Grows an independent tree in a worker, and returns the packed actions, visits, rewards and proofs of the root children and the visits of the root.
+    fen, moves: The starting position of the game and the packed moves played since
+    options: The settings of the search
+    """
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    board = chess.Board(fen)
+    for move in moves:
+        board.push(unpack_move(move))
+    mcts = MonteCarloTreeSearch(policy=_worker_policy, reuse_tree=False, **options)
+    v0 = mcts._start(board)
+    mcts._serial(v0)
+    index = v0.get_child_index()
+    return [pack_move(a) for a in v0.get_actions()], mcts.stats.visits[index].tolist(), mcts.stats.results[index].tolist(), \
+        mcts.stats.proven[index].tolist(), mcts.stats.get_explores(v0.index)
+
+Path = List[Tuple[chess.Move, TreeNode]] # The actions taken and the nodes reached from the root, starting with (None, root)
 
 class Proc:
     def __init__(self) -> None:
-        self.node = None
+        self.path = None
+        self.states = None
         self.active = False
     
-    def assign(self, node:TreeNode):
+    def assign(self, path:Path, states:Tuple[chess.Board, chess.Board]):
         self.active = True
-        self.node = node
+        self.path = path
+        self.states = states # The positions before and after the last move of the path
 
     def done(self):
         self.active = False
 
 class MonteCarloTreeSearch:
-    def __init__(self, exploration_weight=1, time_budget=1, policy: Policy = RandomPolicy(), parallel:bool = False, heuristic_rebate = 0.1) -> None:
+    def __init__(self, exploration_weight=1, time_budget=1, policy: Policy = RandomPolicy(), parallel:bool = False, heuristic_rebate = 0.1, reuse_tree:bool = True, transpositions:bool = False, transposition_capacity:int = 1 << 20, processes:int = None, in_flight:int = None, virtual_loss:int = 0, root_parallel:bool = False, batch_size:int = 1, max_wait:float = 0.01, rollout_depth:int = None, progressive_widening:Tuple[float, float] = None, solver:bool = False) -> None:
+        """
+        processes: The number of worker processes used by the parallel modes, defaults to the number of CPUs
+        in_flight: The number of playouts the parallel mode keeps going at once, defaults to the number of processes.
+            More playouts than processes keeps the workers busy while the tree is updated.
+        virtual_loss: The number of lost visits counted along the path of a playout until its result is back,
+            so playouts in flight at the same time spread out over the tree. 0 = off
+        root_parallel: Grow an independent tree in each process instead of sharing one tree, and merge the statistics
+            of the root children to pick the move. Only a shared policy learns from the playouts of the workers.
+        batch_size: The number of leaves the serial search plays out side by side, so a policy with a batched model
+            picks their moves together (see Policy.pick_moves). 1 = off
+        max_wait: The maximal time in seconds a selected leaf waits for its batch to fill up
+        rollout_depth: The maximal number of moves of a playout, after which the position is scored by a cheap
+            material and mobility evaluation (see evaluation.py). None = play to the end of the game
+        progressive_widening: (k, α) to let a node visited n times have about k·n^α children, adding the actions
+            with the highest expected reward of the policy first. None = add every action before going deeper
+        solver: Prove wins and losses from the checkmates found in the tree (MCTS-Solver). Proven nodes aren't played out
+            again, and the search stops as soon as the root is proven
+        reuse_tree: Keep the tree between moves, and continue from the subtree of the position we get back.
+            A search for the other side (like in self play) starts a new tree, since the rewards are from our point of view
+        transpositions: Share the node of a position between all the move orders reaching it, turning the tree into a DAG
+        transposition_capacity: The maximal number of positions in the transposition table
+        """
         self.policy = policy
         self.c = exploration_weight
         self.time_budget = time_budget
         self.player = None
         self.parallel = parallel
         self.rebate = heuristic_rebate
+        self.reuse_tree = reuse_tree
+        self.root:TreeNode = None # The root of the search
+        self.stats:TreeStats = TreeStats() # The visits and rewards of the nodes
+        self.board:chess.Board = None # The position of the root, the positions of the other nodes are found by pushing their moves
+        self.table:TranspositionTable = TranspositionTable(transposition_capacity) if transpositions else None
+        self.processes = processes or os.cpu_count()
+        self.in_flight = in_flight or self.processes
+        self.virtual_loss = virtual_loss
+        self.root_parallel = root_parallel
+        self.transposition_capacity = transposition_capacity
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.rollout_depth = rollout_depth
+        self.widening = progressive_widening
+        self.solver = solver
+        self.pool:Pool = None # The worker processes, kept between searches
+        self.installed:Policy = None # The policy the workers have
+        self.policy_changed = False # Whether the policy has learned since the workers got it, set it if it is changed from outside
+
+    def _workers(self) -> Pool:
+        """
+        Returns the worker pool, and sends the workers the policy if it has changed since they got it.
+        The processes are kept, only a new shared policy needs new processes since it must be received while they are spawned.
+        """
+        if self.pool is None or (self.policy is not self.installed and self.policy.shared):
+            self.close()
+            self.pool = Pool(self.processes, initializer=_init_worker, initargs=(self.policy, Barrier(self.processes)))
+        elif self.policy is not self.installed or (self.policy_changed and not self.policy.shared):
+            # The workers of a shared policy already see its updates, the others get a copy of its new state
+            self.pool.map(_worker_refresh, [pickle.dumps(self.policy)] * self.processes, chunksize=1)
+        self.installed, self.policy_changed = self.policy, False
+        return self.pool
 
-    def _playouts(self, node:TreeNode, n_playouts:int = 64) -> float:
+    def close(self):
+        "Stops the worker processes"
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _playouts(self, board:chess.Board, n_playouts:int = 64) -> float:
         #start_time = time.time()
-        with Pool() as pool:
-            scores = pool.map(self._simulate, [chess.Board(node.state.fen()) for _ in range(n_playouts)])
+        scores = self._workers().starmap(_worker_playout, [(board.fen(), self.player, self.rollout_depth)] * n_playouts)
         #print("Simulation time %s sec" % ((time.time() - start_time)))
         return sum(scores)/len(scores)
 
     def _simulate(self, board: chess.Board) -> float:
         "Returns the reward for a random simulation (to completion) of the board state"
-        # Run until we hit a terminal state
-        while not board.is_game_over():
-            board.push(self.policy.pick_move(board))
-        # Return 0.5 if it's a draw, otherwise return 1 if current player won or 0 if other player won.
-        #print("%s, " % (board.fullmove_number), end='')
-        return 0.5 if board.is_stalemate() else 1 if board.outcome().winner == self.player else 0
-
-    def _expand(self, node: TreeNode):
-        return node.explore()
-
-    def _select(self, node: TreeNode):
-        "find an unexplored descendent of the board state"
+        return simulate(board, self.policy, self.player, self.rollout_depth)
+
+    def _expand(self, node: TreeNode, board: chess.Board) -> Tuple[chess.Move, TreeNode]:
+        if node.actions is None:
+            # Evaluate the heuristic of every action once, instead of every time the node is selected
+            actions = list(board.legal_moves)
+            priors = self.policy.expected_rewards(board, actions)
+            if self.widening is not None: # Explore the most promising actions first
+                order = np.argsort(-np.asarray(priors, dtype=float), kind='stable')
+                actions, priors = [actions[i] for i in order], [priors[i] for i in order]
+            node.open(actions, priors)
+        return node.explore(board, self.stats, self.table)
+
+    def _expandable(self, node: TreeNode) -> bool:
+        "Whether the node should get another child before the search goes deeper"
+        if node.fully_explored():
+            return False
+        if self.widening is None or node.actions is None:
+            return True
+        k, α = self.widening
+        return node.count_children() < max(1, k * self.stats.get_explores(node.index) ** α)
+
+    def _select(self, node: TreeNode, board: chess.Board) -> Path:
+        """
+        find an unexplored descendent of the board state, and return the path taken to it
+        board: The position of the node, the moves of the path are pushed onto it
+        """
+        path = [(None, node)]
         v = node
-        while not v.state.is_game_over():
-            if not v.fully_explored():
-                output = self._expand(v)
-                output.append_exploration() # Do it up front to affect the selection process early on
-                return output
-            else:
-                v = self._uct_select(v) # Best child
-        return v
+        while not v.is_terminal() and not self.stats.proven[v.index]: # Checked once when the node was created, instead of on every descent
+            if self._expandable(v):
+                action, child = self._expand(v, board)
+                board.push(action)
+                path.append((action, child))
+                break
+            action, child = self._uct_select(v, board) # Best child
+            if any(child is u for _, u in path):
+                break # A repetition leads back to a node on the path, so simulate from here instead of going in circles
+            board.push(action)
+            path.append((action, child))
+            v = child
+        self.stats.count_exploration([u.index for _, u in path]) # Do it up front to affect the selection process early on
+        return path
+
+    def _states(self, path:Path, board: chess.Board) -> Tuple[chess.Board, chess.Board]:
+        "Copies the positions before and after the last move of the path, while the board is at the end of the path"
+        new_state = board.copy(stack=False)
+        if len(path) == 1:
+            return None, new_state
+        action = board.pop()
+        state = board.copy(stack=False)
+        board.push(action)
+        return state, new_state
 
-    def _backpropagate(self, node:TreeNode, reward):
-        "Send the reward back up the ancestors of the leaf"
+    def _unwind(self, path:Path, board: chess.Board):
+        "Pops the moves of the path, so the board is back at the root"
+        for _ in range(len(path) - 1):
+            board.pop()
+
+    def _backpropagate(self, path:Path, reward, state:chess.Board = None, new_state:chess.Board = None):
+        """
+        Send the reward back along the path taken to the leaf
+        state, new_state: The positions before and after the last move of the path, to update trainable policies
+        """
         
         # Update trainable policies
-        self.policy.update(node.parent.state, node.action, reward, node.state)
+        if state is not None:
+            self.policy.update(state, path[-1][0], reward, new_state)
+            self.policy_changed = True
 
-        v = node
-        while True:
-            v.update_result(reward)
-            if v.parent is None:
-                break
-            v = v.parent
+        self.stats.update_result([v.index for _, v in path], reward)
+        if self.solver:
+            self._solve(path)
+
+    def _solve(self, path:Path):
+        "Proves the nodes of the path from the leaf up, as long as the node below it was proven"
+        leaf = path[-1][1]
+        if not self.stats.proven[leaf.index]:
+            if not leaf.is_terminal() or leaf.outcome.winner is None:
+                return # Only a checkmate proves anything, draws are scored like before
+            self.stats.prove(leaf.index, leaf.outcome.winner)
+        for depth in range(len(path) - 2, -1, -1):
+            v = path[depth][1]
+            if self.stats.proven[v.index]:
+                return
+            mover = self.player if depth % 2 == 0 else not self.player # The root is the position of our move
+            if not self._prove(v, mover):
+                return
+
+    def _prove(self, node:TreeNode, mover:chess.Color) -> bool:
+        "Proves a win if the side to move has a move to a proven win, or a loss if all its moves are proven losses"
+        sign = 1 if mover == chess.WHITE else -1
+        proven = self.stats.proven[node.get_child_index()] * sign # 1 for a win of the side to move, -1 for a loss
+        if (proven == 1).any():
+            self.stats.prove(node.index, mover)
+        elif node.fully_explored() and (proven == -1).all():
+            self.stats.prove(node.index, not mover)
+        else:
+            return False
+        return True
     
-    def _uct_select(self, parent: TreeNode):
+    def _uct_select(self, parent: TreeNode, board: chess.Board) -> Tuple[chess.Move, TreeNode]:
         "Select a child of state, balancing exploration & exploitation"
-        
-        best_result = float('-inf')
-        best_child = None
-
-        # Go through children to find the best option
-        for action in parent.get_actions():
-            child = parent.get_child(action)
-            
-            # Calculate a score
-            # 1. Take the average from previous simulations (win:1, draw:0.5, loss=0)
-            # 2. Heuristic for action + self.policy.expected_reward(parent.state, child.action)
-            # 3. Add the upper confidence bound (√2ln(n)/nj)
-            result = child.get_average() + \
-                self.rebate * self.policy.expected_reward(parent.state, child.action) + \
-                self.c * math.sqrt((2*math.log(parent.get_explores()+1))/(child.get_explores()+1))
-            
-            # If this child score is the best current score
-            if result > best_result:
-                best_result = result
-                best_child = child
-
-        # Return the child with the best score
-        return best_child
-
-    def _playout(self, node:TreeNode) -> Tuple[TreeNode, float]:
-        return node, self._simulate(chess.Board(node.state.fen()))
+        index = parent.get_child_index()
+        visits = self.stats.visits[index]
+
+        # Calculate a score for all children at once
+        # 1. Take the average from previous simulations (win:1, draw:0.5, loss=0)
+        # 2. Heuristic for action, evaluated when the parent was expanded
+        # 3. Add the upper confidence bound (√2ln(n)/nj)
+        scores = self.stats.results[index] / np.maximum(visits, 1) + \
+            self.rebate * parent.get_priors() + \
+            self.c * np.sqrt((2*math.log(self.stats.visits[parent.index]+1))/(visits+1))
+
+        if self.solver: # Always take a proven win, and only take a proven loss if everything else is lost too
+            sign = 1 if board.turn == chess.WHITE else -1
+            scores += 1e9 * sign * self.stats.proven[index]
+
+        # Return the action with the best score, and its child
+        best = int(np.argmax(scores))
+        return parent.actions[best], parent.children[best]
+
+    def _playout(self, board:chess.Board) -> float:
+        return self._simulate(board.copy(stack=False))
+
+    def _known_reward(self, node: TreeNode) -> float:
+        "The reward of a node where the game is over or its result is proven, which needs no playout, otherwise None"
+        if node.is_terminal():
+            return _outcome_reward(node.outcome, self.player)
+        winner = self.stats.get_proven(node.index)
+        if winner is not None:
+            return 1 if winner == self.player else 0
+        return None
+
+    def _searching(self, start_time: float, v0: TreeNode) -> bool:
+        "Whether there is time left, and the result of the root isn't proven yet"
+        return time.time() - start_time < self.time_budget and not self.stats.proven[v0.index]
 
     def _serial(self, v0):
         start_time = time.time()
-        while time.time() - start_time < self.time_budget:
-            v = self._select(v0)
-            value = self._simulate(chess.Board(v.state.fen()))
-            self._backpropagate(v, value)
+        board = self.board.copy()
+        while self._searching(start_time, v0):
+            path = self._select(v0, board)
+            state, new_state = self._states(path, board)
+            self._unwind(path, board)
+            value = self._known_reward(path[-1][1])
+            if value is None:
+                value = self._simulate(new_state.copy(stack=False))
+            self._backpropagate(path, value, state, new_state)
+
+    def _batch_done(self, path:Path, state:chess.Board, new_state:chess.Board, value:float):
+        if self.virtual_loss:
+            self.stats.revert_virtual_loss([v.index for _, v in path], self.virtual_loss)
+        self._backpropagate(path, value, state, new_state)
+
+    def _batched(self, v0):
+        start_time = time.time()
+        board = self.board.copy()
+        evaluator = BatchEvaluator(self.policy, self.player, self.batch_size, self.max_wait, self.rollout_depth)
+        while self._searching(start_time, v0):
+            path = self._select(v0, board)
+            state, new_state = self._states(path, board)
+            self._unwind(path, board)
+            value = self._known_reward(path[-1][1])
+            if value is not None:
+                self._backpropagate(path, value, state, new_state)
+                continue
+            if self.virtual_loss:
+                self.stats.apply_virtual_loss([v.index for _, v in path], self.virtual_loss)
+            evaluator.add(new_state.copy(stack=False), functools.partial(self._batch_done, path, state, new_state))
+            if evaluator.ready():
+                evaluator.run()
+        evaluator.run() # Play out the last leaves
 
     def _serial_parallel_playouts(self, v0):
-        v = self._select(v0)
-        value = self._playouts(v, os.cpu_count())
-        self._backpropagate(v, value)
+        board = self.board.copy()
+        path = self._select(v0, board)
+        state, new_state = self._states(path, board)
+        value = self._known_reward(path[-1][1])
+        if value is None:
+            value = self._playouts(new_state, self.processes)
+        self._backpropagate(path, value, state, new_state)
 
     def _proc_done(self, result):
-        self._backpropagate(self.procs[result[0]].node, result[1])
-        self.procs[result[0]].done()
-    
-    def _proc_sim(self, i:int, board:chess.Board) -> Tuple[int, float]:
-        return i, self._simulate(chess.Board(board.fen()))
+        proc = self.procs[result[0]]
+        if self.virtual_loss:
+            self.stats.revert_virtual_loss([v.index for _, v in proc.path], self.virtual_loss)
+        # A shared policy has already been updated by the worker
+        self._backpropagate(proc.path, result[1], *((None, None) if self.policy.shared else proc.states))
+        proc.done()
+
+    def _dispatch(self, pool:Pool, i:int, v0:TreeNode, board:chess.Board, done:queue.SimpleQueue):
+        "Selects a leaf for the proc, and sends its position to a worker"
+        proc = self.procs[i]
+        path = self._select(v0, board)
+        proc.assign(path, self._states(path, board))
+        self._unwind(path, board)
+        if self.virtual_loss:
+            self.stats.apply_virtual_loss([v.index for _, v in path], self.virtual_loss)
+        state, new_state = proc.states
+        value = self._known_reward(path[-1][1])
+        if value is not None: # Hand the reward straight back, without a worker
+            if self.policy.shared and state is not None:
+                self.policy.update(state, path[-1][0], value, new_state) # Like a worker would have
+            done.put((i, value))
+            return
+        if state is None:
+            task = (i, new_state.fen(), None, self.player, self.rollout_depth)
+        else:
+            task = (i, state.fen(), pack_move(path[-1][0]), self.player, self.rollout_depth)
+        pool.apply_async(_worker_simulate, task, callback=done.put, error_callback=done.put)
 
     def _parallel(self, v0):
         start_time = time.time()
-        self.procs = [Proc() for _ in range(os.cpu_count())]
-        with Pool() as pool:
-            while time.time() - start_time < self.time_budget:
-                for i, proc in enumerate(self.procs):
-                    if not proc.active:
-                        proc.assign(self._select(v0))
-                        pool.apply_async(self._proc_sim, args=(i, proc.node.state), callback=self._proc_done)
-                time.sleep(0.01)
-            pool.close()
-            pool.join()
+        pool = self._workers()
+        board = self.board.copy()
+        done = queue.SimpleQueue() # The results, handed over by the pool as soon as they are done
+        self.procs = [Proc() for _ in range(self.in_flight)] # The pool queues the playouts its workers can't take yet
+        for i in range(len(self.procs)):
+            self._dispatch(pool, i, v0, board, done)
+
+        # Wait for results and put the worker back to work, until the time is up and the last playouts are back
+        while any(proc.active for proc in self.procs):
+            result = done.get()
+            if isinstance(result, BaseException):
+                raise result
+            self._proc_done(result)
+            if self._searching(start_time, v0):
+                self._dispatch(pool, result[0], v0, board, done)
+
+    def _root_parallel(self, v0):
+        # The workers search with the same settings, but each with their own random seed
+        options = dict(exploration_weight=self.c, time_budget=self.time_budget, heuristic_rebate=self.rebate,
+            transpositions=self.table is not None, transposition_capacity=self.transposition_capacity, rollout_depth=self.rollout_depth,
+            progressive_widening=self.widening, solver=self.solver)
+        moves = [pack_move(m) for m in self.board.move_stack]
+        tasks = [(random.getrandbits(64), self.board.root().fen(), moves, options) for _ in range(self.processes)]
+        trees = self._workers().starmap(_worker_search, tasks)
+
+        # Add all the root children, and sum up their statistics
+        board = self.board.copy()
+        while not v0.is_terminal() and not v0.fully_explored():
+            self._expand(v0, board)
+        index = dict(zip(v0.get_actions(), v0.get_child_index()))
+        for actions, visits, results, proven, explores in trees:
+            children = [index[unpack_move(a)] for a in actions]
+            self.stats.visits[children] += visits
+            self.stats.results[children] += results
+            self.stats.proven[children] |= np.asarray(proven, dtype=np.int8) # A proof holds whichever worker found it
+            self.stats.visits[v0.index] += explores
+        if self.solver and not v0.is_terminal():
+            self._prove(v0, self.player)
+
+    def _reuse(self, board: chess.Board) -> TreeNode:
+        "Find the node of the board in the previous tree by following the moves played since, or None if it isn't there"
+        if self.root is None or len(board.move_stack) < len(self.board.move_stack):
+            return None
+        if board.turn != self.player: # The rewards of the old tree are from the point of view of the other side
+            return None
+        v = self.root
+        previous = self.board.copy()
+        for move in board.move_stack[len(previous.move_stack):]: # Our own move and the reply of the opponent
+            if move not in v.get_actions():
+                return None
+            v = v.get_child(move)
+            previous.push(move)
+        if previous.fen() != board.fen(): # Not the same game
+            return None
+        return v
+
+    def _start(self, board: chess.Board) -> TreeNode:
+        "Sets up the root of a search of the board, continuing from the previous tree if possible"
+        v0 = self._reuse(board) if self.reuse_tree else None
+        if v0 is None:
+            self.stats = TreeStats()
+            v0 = TreeNode(None, self.stats.add(), board.outcome())
+            if self.table is not None:
+                self.table.clear()
+                self.table.add(chess.polyglot.zobrist_hash(board), v0)
+        else:
+            self.stats.compact(v0) # Forget the statistics of the released part of the old tree
+            if self.table is not None:
+                self.table.retain(v0) # And its positions
+        self.root, self.board = v0, board.copy() # Copy, since the game continues on the board
+        self.player = board.turn
+        self.policy.start_search()
+        return v0
+
+    def _best_action(self, v0: TreeNode) -> chess.Move:
+        """
+        The move to play after the search, a mate if there is one and otherwise the most visited child of the root.
+        The exploration bonus of UCT isn't used here, since it would prefer a rarely visited move over a good one.
+        """
+        index = v0.get_child_index()
+        scores = self.stats.visits[index].astype(float)
+        # Play a mate right away, even if the playouts after another move won just as often
+        scores += 1e18 * np.array([c.is_terminal() and c.outcome.winner == self.board.turn for c in v0.children], dtype=float)
+        if self.solver: # A proven win beats any number of visits, and a proven loss is only taken if everything else is lost too
+            sign = 1 if self.board.turn == chess.WHITE else -1
+            scores += 1e18 * sign * self.stats.proven[index]
+        return v0.actions[int(np.argmax(scores))]
 
     def choose(self, board: chess.Board) -> chess.Move:
         "Choose a move in the game and execute it"
-        v0 = TreeNode(board)
-        self.player = board.turn
-        if self.parallel:
+        v0 = self._start(board)
+        reused = self.stats.get_explores(v0.index)
+        if self.root_parallel:
+            self._root_parallel(v0)
+        elif self.parallel:
             self._parallel(v0)
+        elif self.batch_size > 1:
+            self._batched(v0)
         else:
             self._serial(v0)
-        print("Explorations: %s" % (v0.get_explores()))
-        return self._uct_select(v0).action
\ No newline at end of file
+        print("Explorations: %s (%s reused)" % (self.stats.get_explores(v0.index), reused))
+        return self._best_action(v0)
\ No newline at end of file
@@ -1,13 +1,13 @@
-import time
 from typing import Sequence
+import numpy as np
 from nn_layer import NNLayer
-from node import Node
+from tensor import Tensor
 
 class MultiLayeredNetwork:
     def __init__(self, layers:Sequence[NNLayer]) -> None:
         self.layers = layers
     
-    def parameters(self) -> Sequence[Node]:
+    def parameters(self) -> Sequence[Tensor]:
         """
         Returns all the parameters of the layers as a flat list
         """
@@ -16,7 +16,7 @@ class MultiLayeredNetwork:
             output.extend(layer.parameters()) # Get a flat list of parameters from each layer
         return output
 
-    def forward(self, input: Sequence[Node]) -> Sequence[Node]:
+    def forward(self, input: Tensor) -> Tensor:
         """
         Computes the forward pass of the multi layered network.
         """
@@ -25,4 +25,20 @@ class MultiLayeredNetwork:
             x = layer.forward(x) # The output is passed on as input for the next layer
                     
         # Return the last output
-        return x
\ No newline at end of file
+        return x
+
+    def get_weights(self) -> Sequence[float]:
+        """
+        Returns all the parameter values as one flat list, in the same order as the scalar implementation stored them
+        """
+        return [float(v) for p in self.parameters() for v in p.value.ravel()]
+
+    def set_weights(self, weights: Sequence[float]) -> None:
+        """
+        Restores parameter values from a flat list, e.g. loaded from pCNN-params.json
+        """
+        offset = 0
+        for p in self.parameters():
+            p.value[...] = np.reshape(weights[offset:offset + p.value.size], p.shape)
+            offset += p.value.size
+        assert offset == len(weights), "The number of weights must match the number of parameters"
\ No newline at end of file
@@ -1,9 +1,9 @@
 from typing import Sequence
-from node import Node
+from tensor import Tensor
 
 class NNLayer:
-    def parameters(self) -> Sequence[Node]:
+    def parameters(self) -> Sequence[Tensor]:
         return []
     
-    def forward(self, inputs: Sequence[Node]) -> Sequence[Node]:
+    def forward(self, inputs: Tensor) -> Tensor:
         pass
\ No newline at end of file
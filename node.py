@@ -1,8 +1,6 @@
 from math import e, tanh
 from typing import Sequence, Tuple, Union
 
-from numpy.lib.function_base import gradient
-
 class Node:
     def __init__(self, value: float, parents = None):
         self.value = value
@@ -17,16 +15,26 @@ class Node:
     def __repr__(self):
         return "Node (value=%.4f, gradient=%.4f)" % (self.value, self.grad)
 
-    def backprop(self, df_dnode):
-        self.grad += df_dnode
-        for parent, gradient in self.parents:
-            parent.backprop(gradient * df_dnode)
+    def backprop(self, df_dnode, release_graph: bool = False):
+        """
+        Propagates df_dnode to every (upstream) node, visiting each node exactly once.
+
+        release_graph: Drop the parents of every visited node afterwards, so the graph can be reclaimed
+        """
+        grads = {id(self): df_dnode}
+        for node in topological_order(self):
+            df = grads.pop(id(node), 0.0) # Every node downstream has already added its contribution
+            node.grad += df
+            for parent, gradient in node.parents:
+                grads[id(parent)] = grads.get(id(parent), 0.0) + gradient * df
+            if release_graph:
+                node.parents = []
 
-    def backward(self):
+    def backward(self, release_graph: bool = False):
         """
         Computes the gradient of every (upstream) node in the computational graph w.r.t. node.
         """
-        self.backprop(1.0)  # The gradient of a node w.r.t. itself is 1 by definition.
+        self.backprop(1.0, release_graph)  # The gradient of a node w.r.t. itself is 1 by definition.
 
     def __add__(self, other):
         return Node(self.value + other.value, [(self, 1.0), (other, 1.0)])
@@ -63,4 +71,29 @@ def plus(a: Node, b: Node) -> Node:
     return Node(a.value + b.value, [(a, a.value), (b, b.value)])
 
 def multiply(a: Node, b: Node) -> Node:
-    return Node(a.value*b.value, [(a,a.value), (b, b.value)])
\ No newline at end of file
+    return Node(a.value*b.value, [(a,a.value), (b, b.value)])
+
+def topological_order(root) -> Sequence:
+    """
+    Returns every node in the graph above root, ordered so a node comes before all of its parents.
+    
+    The graph is traversed iteratively, so deep graphs can't hit the recursion limit.
+    Works for any node type with a list of (parent, gradient) pairs, e.g. Node and Tensor.
+    """
+    order = []
+    visited = set()
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            order.append(node) # All parents are placed, so the node goes after them
+            continue
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        stack.append((node, True))
+        for parent, _ in node.parents:
+            if id(parent) not in visited:
+                stack.append((parent, False))
+    order.reverse()
+    return order
\ No newline at end of file
@@ -1,11 +1,25 @@
+from typing import Sequence
 import chess
 
 class Policy:
+    shared = False # Whether updates made in worker processes reach the policy of every other process
+
     def pick_move(self, board: chess.Board) -> chess.Move:
         pass
 
+    def start_search(self) -> None:
+        "Called by a search before it starts, policies can drop what they cached for the previous search"
+        pass
+
+    def pick_moves(self, boards: Sequence[chess.Board]) -> Sequence[chess.Move]:
+        "Picks a move for each of the boards, policies with a batched model can do it in one go"
+        return [self.pick_move(board) for board in boards]
+
     def expected_reward(self, board: chess.Board, action: chess.Move) -> float:
         return 0
 
+    def expected_rewards(self, board: chess.Board, actions: Sequence[chess.Move]) -> Sequence[float]:
+        return [self.expected_reward(board, action) for action in actions]
+
     def update(self, state: chess.Board, action: chess.Move, reward: float, new_state: chess.Board) -> None:
         pass
\ No newline at end of file
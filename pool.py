@@ -1,6 +1,9 @@
-from typing import Sequence
-from node import Node
+from typing import Tuple
 from math import prod
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from nn_layer import NNLayer
+from tensor import Tensor, as_tensor
 
 """
 A basic pooling layer, implemented by Thomas Volden.
@@ -10,14 +13,27 @@ Sources of inspiration:
 - https://en.wikipedia.org/wiki/Convolutional_neural_network
 """
 class PoolingStrategy:
-    def compute(values:Sequence[Node]) -> Node:
+    def compute(self, windows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        windows: The values of every pool, with the values of each pool along the last axis
+
+        Returns the pooled value of each pool, and how much each value in the pool contributes to the gradient
+        """
         raise NotImplementedError
 
 class MaxPooling(PoolingStrategy):
-    def compute(values: Sequence[Node]) -> Node:
-        return max(values) # Return the maximum number of the pool
+    def compute(self, windows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        idx = np.argmax(windows, axis=-1)[..., None] # The position of the maximum number of each pool
+        routing = np.zeros_like(windows)
+        np.put_along_axis(routing, idx, 1.0, axis=-1) # Only the maximum receives the gradient
+        return np.take_along_axis(windows, idx, axis=-1)[..., 0], routing
 
-class Pool:
+class AveragePooling(PoolingStrategy):
+    def compute(self, windows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        n = windows.shape[-1]
+        return windows.mean(axis=-1), np.full_like(windows, 1.0 / n) # Every value in the pool shares the gradient
+
+class Pool(NNLayer):
     def __init__(self, stride:int, shape:int, input_shape:tuple[int, int, int], strategy:PoolingStrategy = MaxPooling()):
         """
         stride: The number of positions to move for each iteration (both left and down)
@@ -29,31 +45,38 @@ class Pool:
         self.shape = shape
         self.input_shape = input_shape
         self.strategy = strategy
+        self.steps_x = int((self.input_shape[0] - self.shape) / self.stride) + 1 # Calculate max number of moves to the left giving the strider value
+        self.steps_y = int((self.input_shape[1] - self.shape) / self.stride) + 1 # Calculate max number of moves to the bottom giving the strider value
+        # The position in the flat input of every value in every pool, found by taking the same windows over the input positions
+        self.window_index = self._windows(np.arange(prod(self.input_shape)))
 
-    def pool(self, inputs: Sequence[Node]) -> Sequence[Node]:
+    def _windows(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        Returns strided views of the pools of a (batch of) flat input(s) as (..., channels, steps_y, steps_x, shape*shape)
+        """
+        x = inputs.reshape(inputs.shape[:-1] + (self.input_shape[2], self.input_shape[1], self.input_shape[0]))
+        windows = sliding_window_view(x, (self.shape, self.shape), axis=(-2, -1))[..., ::self.stride, ::self.stride, :, :]
+        return windows.reshape(windows.shape[:-2] + (self.shape * self.shape,))
+
+    def forward(self, inputs: Tensor) -> Tensor:
         """ 
-        inputs: input values from the two dimentional value map and number of channels
+        inputs: input values from the two dimentional value map and number of channels.
+            Either a single flat input or a batch of them (N, x*y*c).
 
         Check to see if the lenght of inputs are equal to the product of the defined shape (x*y*c)
         """
-        assert prod(self.input_shape) == len(inputs), "The input must meet the defined shape"
-        output = []
-        steps_x = int((self.input_shape[0] - self.filter_size) / self.stride) + 1 # Calculate max number of moves to the left giving the strider value
-        steps_y = int((self.input_shape[1] - self.filter_size) / self.stride) + 1 # Calculate max number of moves to the bottom giving the strider value
+        inputs = as_tensor(inputs)
+        assert prod(self.input_shape) == inputs.shape[-1], "The input must meet the defined shape"
         
-        for c in range(self.input_shape[2]): # For each channel
-            for y in range(steps_y): # For each move to the bottom
-                for x in range(steps_x): # For each move to the left
-                    # Append j,i value from filter bank to x,y value
-                    values = []
-                    for i in range(self.shape):
-                        for j in range(self.shape):
-                            channel = c * self.input_shape[0] * self.input_shape[1] # Skip whole areas (height*width)
-                            stride_y = y * self.stride # Calculate the stride offset for the y direction
-                            stride_x = x * self.stride # Calculate the stride offset for the x direction
-                            row = (i + stride_y) * self.input_shape[0] # Jump over a width for each row plus y stride offset
-                            col = stride_x + j # The column plus x stride offset
-                            values.append(inputs[channel + row + col])
-                    # Parse the value through our pooling strategy to get one value
-                    output.append(self.strategy.compute(values))
-        return output
\ No newline at end of file
+        # Parse the pools through our pooling strategy to get one value per pool
+        output, routing = self.strategy.compute(self._windows(inputs.value))
+        size = self.input_shape[2] * self.steps_y * self.steps_x
+
+        def backward_fn(df):
+            dwindows = df.reshape(routing.shape[:-1] + (1,)) * routing # Route the gradient of each pool to its values
+            # Pools may overlap, so we accumulate the values into the flat input of each sample in the batch
+            x = inputs.value.reshape(-1, inputs.shape[-1])
+            index = (self.window_index.reshape(1, -1) + np.arange(len(x)).reshape(-1, 1) * x.shape[1]).ravel()
+            return np.bincount(index, weights=dwindows.ravel(), minlength=x.size).reshape(inputs.shape)
+
+        return Tensor(output.reshape(inputs.shape[:-1] + (size,)), [(inputs, backward_fn)])
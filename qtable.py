@@ -1,7 +1,11 @@
 import random
-from typing import Dict
+from typing import Dict, Hashable, Sequence
 from chess import Move, Board
+from chess.polyglot import zobrist_hash
+from chess_utils import pack_move, unpack_move
 from policy import Policy
+import qtable_binary
+from qtable_binary import BinaryQTable
 
 class QTable(Policy):
     def __init__(self, learning_rate = 0.1, discount_rate = 1.0, ε = 0.3) -> None:
@@ -10,49 +14,70 @@ class QTable(Policy):
         discount_rate: Adjust how much the next states expected value should influence the reward
         ε: Control how often the table should be used. 0 = always, 1 = never
         """
-        self.table:Dict[str, Dict[str, float]] = {}
+        self.table:Dict[Hashable, Dict[Hashable, float]] = {}
         self.learning_rate = learning_rate
         self.discount_rate = discount_rate
         self.ε = ε
-    
+
+    def _state_key(self, state: Board) -> Hashable:
+        return str(state.fen()) # Convert the board into a hashable representation that can be used to restore the board
+
+    def _action_key(self, action: Move) -> Hashable:
+        return action.uci()
+
+    def _to_move(self, key: Hashable) -> Move:
+        return Move.from_uci(key) # Convert from string to Move
+
+    def _lookup(self, state: Board) -> Dict[Hashable, float]:
+        """Returns the actions stored for the state, or None if we don't have the state"""
+        return self.table.get(self._state_key(state))
+
     def pick_move(self, state: Board) -> Move:
-        s = str(state.fen()) # Convert the board into a hashable representation that can be used to restore the board
+        actions = self._lookup(state)
 
         # Check if state is in table and roll dice to see if the look up table should be used
-        if s in self.table and random.uniform(0,1) > self.ε:
-            actions = self.table[s] # Lookup action
-            return Move.from_uci(max(actions, key=actions.get)) # Convert from string to Move
-        
+        if actions and random.uniform(0,1) > self.ε:
+            return self._to_move(max(actions, key=actions.get))
+
         # If we don't have the state or we didn't hit a high enough number by chance, then take a random action
-        return random.choice([m for m in state.legal_moves]) 
+        return random.choice([m for m in state.legal_moves])
 
     def expected_reward(self, state: Board, action: Move) -> float:
-        # Convert the board and action into hashable representations that can be restored later
-        s = str(state.fen()) 
-        a = action.uci() 
-
         # If we have the state and action, then return the value we have stored for it
-        return self.table[s][a] if s in self.table and a in self.table[s] else 0
+        actions = self._lookup(state)
+        return actions.get(self._action_key(action), 0) if actions else 0
+
+    def expected_rewards(self, state: Board, actions: Sequence[Move]) -> Sequence[float]:
+        # Only convert the state once for all the actions
+        stored = self._lookup(state)
+        if not stored:
+            return [0] * len(actions)
+        return [stored.get(self._action_key(a), 0) for a in actions]
 
     def _max(self, state: Board) -> float:
-        s = str(state.fen()) # Convert board into hashable value 
-        
+        actions = self._lookup(state)
+
         # If we don't have the state, then early out
-        if s not in self.table:
+        if not actions:
             return 0
 
-        return max(self.table[s].values()) # Find the max value for all actions in state
+        return max(actions.values()) # Find the max value for all actions in state
 
-    def update(self, state: Board, action: Move, reward: float, new_state: Board) -> None:
-        # Convert the board and action into hashable representations that can be restored later
-        s = str(state.fen())
-        a = action.uci()
-
-        # Make sure the state and action is in the table
+    def _entry(self, state: Board) -> Dict[Hashable, float]:
+        """Returns the actions stored for the state, and makes sure the state is in the table"""
+        s = self._state_key(state)
         if (s not in self.table):
             self.table[s] = { }
-        if (a not in self.table[s]):
-            self.table[s][a] = 0
+        return self.table[s]
+
+    def update(self, state: Board, action: Move, reward: float, new_state: Board) -> None:
+        # Convert the action into a hashable representation that can be restored later
+        actions = self._entry(state)
+        a = self._action_key(action)
+
+        # Make sure the action is in the table
+        if (a not in actions):
+            actions[a] = 0
 
         # Update the value for state->action:
         # 1. Previously stored value
@@ -60,4 +85,99 @@ class QTable(Policy):
         #   2a. Take the new reward
         #   2b. Append the maximum expected reward from the resulting state adjusted with a rebate
         #   2c. Subtract the current value
-        self.table[s][a] = self.table[s][a] + self.learning_rate * (reward + self.discount_rate * self._max(new_state) - self.table[s][a])
\ No newline at end of file
+        actions[a] = actions[a] + self.learning_rate * (reward + self.discount_rate * self._max(new_state) - actions[a])
+
+class ZobristQTable(QTable):
+    def __init__(self, learning_rate = 0.1, discount_rate = 1.0, ε = 0.3, check_collisions = False) -> None:
+        """
+        A Q-Table keyed by 64 bit Zobrist hashes (polyglot hashing), with moves packed as 16 bit integers.
+        Looking up a state computes one hash instead of a FEN string.
+
+        check_collisions: Also store the position of each hash and treat a different position as unknown.
+            The position is the FEN without the move counters (EPD), since the counters aren't part of the hash either.
+        """
+        super().__init__(learning_rate, discount_rate, ε)
+        self.table:Dict[int, Dict[int, float]] = {}
+        self.check_collisions = check_collisions
+        self.positions:Dict[int, str] = {} # The position behind each hash, only used when checking for collisions
+        self.backing:BinaryQTable = None # A read only binary Q-Table file, consulted for states not in the table
+
+    def _state_key(self, state: Board) -> int:
+        return zobrist_hash(state)
+
+    def _action_key(self, action: Move) -> int:
+        return pack_move(action)
+
+    def _to_move(self, key: int) -> Move:
+        return unpack_move(key)
+
+    def _from_backing(self, s: int, state: Board) -> Dict[int, float]:
+        """Returns the actions the binary Q-Table file has for the state, or None if it doesn't have the state"""
+        i = self.backing.index(s) if self.backing is not None else None
+        if i is None:
+            return None
+        if self.check_collisions and self.backing.has_positions() and _epd(self.backing.position(i)) != state.epd():
+            return None # Another position has the same hash
+        moves, values = self.backing.actions(i)
+        return dict(zip(moves.tolist(), values.tolist()))
+
+    def _lookup(self, state: Board) -> Dict[int, float]:
+        s = self._state_key(state)
+        if s not in self.table:
+            return self._from_backing(s, state)
+        if self.check_collisions and self.positions[s] != state.epd():
+            return None # Another position has the same hash
+        return self.table[s]
+
+    def _entry(self, state: Board) -> Dict[int, float]:
+        s = self._state_key(state)
+        if self.check_collisions:
+            position = state.epd()
+            if self.positions.get(s) != position:
+                self.positions[s] = position # Either a new state or a collision, where the newest position wins
+                self.table[s] = self._from_backing(s, state) or { }
+        if (s not in self.table):
+            self.table[s] = self._from_backing(s, state) or { } # Copy the state from the file before it is changed
+        return self.table[s]
+
+    def load_fen_table(self, table: Dict[str, Dict[str, float]]) -> None:
+        """
+        Converts and adds a FEN keyed table, e.g. loaded from qtable.json.
+        FENs only differing in the move counters end up in the same entry, where the last value of each action wins.
+        """
+        for fen, actions in table.items():
+            entry = self._entry(Board(fen))
+            for action, value in actions.items():
+                entry[pack_move(Move.from_uci(action))] = value
+
+    def to_fen_table(self) -> Dict[str, Dict[str, float]]:
+        """
+        Converts the table back into a FEN keyed table that can be saved as JSON.
+        Requires check_collisions, since the positions can't be restored from the hashes alone.
+        """
+        assert self.check_collisions, "The positions are only stored when checking for collisions"
+        return {self.positions[s] + " 0 1": {unpack_move(a).uci(): v for a, v in actions.items()} for s, actions in self.table.items()}
+
+    def load_binary(self, path: str) -> None:
+        """
+        Opens a binary Q-Table file (see qtable_binary.py) to back the table.
+        The file is memory mapped, so states are only read when they are looked up.
+        """
+        self.backing = BinaryQTable(path)
+
+    def save_binary(self, path: str) -> None:
+        """
+        Writes the table, merged with the states of the binary Q-Table file backing it, to a binary Q-Table file.
+        Positions are only stored when checking for collisions.
+        """
+        table, positions = {}, {}
+        if self.backing is not None:
+            table = dict(self.backing.items())
+            if self.backing.has_positions():
+                positions = {int(s): self.backing.position(i) for i, s in enumerate(self.backing.keys)}
+        table.update(self.table)
+        positions.update({s: p + " 0 1" for s, p in self.positions.items()})
+        qtable_binary.write(path, table, positions if self.check_collisions else None)
+
+def _epd(fen: str) -> str:
+    return " ".join(fen.split(" ")[:4]) # The FEN without the move counters
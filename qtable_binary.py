@@ -0,0 +1,149 @@
+import json
+import struct
+from typing import Dict, Iterator, Optional, Tuple
+import numpy as np
+from chess import Board, Move
+from chess.polyglot import zobrist_hash
+from chess_utils import pack_move, unpack_move
+
+"""
+A compact binary Q-Table file.
+
+The file holds the states sorted by their Zobrist hash, so a state is found by a binary search in a memory mapped file
+without loading the whole table. Layout (little endian, every array aligned to 8 bytes):
+
+    header: magic, version, number of states, number of actions, whether positions are stored
+    keys: uint64 Zobrist hash of each state (sorted)
+    offsets: uint64 index of the first action of each state (plus one for the end)
+    moves: uint16 packed moves, see chess_utils.pack_move
+    values: float64 value of each move
+    position offsets: uint64 index of the first byte of each FEN (plus one for the end), if positions are stored
+    positions: the FEN of each state as ascii, if positions are stored
+"""
+
+MAGIC = b"QTB1"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQ?7x")
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+class BinaryQTable:
+    def __init__(self, path: str) -> None:
+        """
+        path: The binary Q-Table file to open. The file is memory mapped and only read when queried.
+        """
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, n_states, n_actions, has_positions = HEADER.unpack_from(self.buffer[:HEADER.size].tobytes())
+        assert magic == MAGIC and version == VERSION, "The file must be a binary Q-Table"
+
+        # Create views of each array in the file
+        offset = _align(HEADER.size)
+        def view(dtype, count):
+            nonlocal offset
+            array = self.buffer[offset:offset + count * np.dtype(dtype).itemsize].view(dtype)
+            offset = _align(offset + array.nbytes)
+            return array
+        self.keys = view('<u8', n_states)
+        self.offsets = view('<u8', n_states + 1)
+        self.moves = view('<u2', n_actions)
+        self.values = view('<f8', n_actions)
+        self.position_offsets = view('<u8', n_states + 1) if has_positions else None
+        self.positions = self.buffer[offset:] if has_positions else None
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def has_positions(self) -> bool:
+        return self.positions is not None
+
+    def index(self, key: int) -> Optional[int]:
+        """Returns the index of the state with the Zobrist hash, or None if the state isn't stored"""
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        return i if i < len(self.keys) and self.keys[i] == key else None
+
+    def actions(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the packed moves and values of the state at index i"""
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.moves[start:end], self.values[start:end]
+
+    def lookup(self, key: int) -> Optional[Dict[int, float]]:
+        """Returns the packed moves and values of the state with the Zobrist hash, or None if the state isn't stored"""
+        i = self.index(key)
+        if i is None:
+            return None
+        moves, values = self.actions(i)
+        return dict(zip(moves.tolist(), values.tolist()))
+
+    def position(self, i: int) -> str:
+        """Returns the FEN of the state at index i"""
+        assert self.has_positions(), "The file doesn't store positions"
+        start, end = int(self.position_offsets[i]), int(self.position_offsets[i + 1])
+        return self.positions[start:end].tobytes().decode('ascii')
+
+    def items(self) -> Iterator[Tuple[int, Dict[int, float]]]:
+        """Iterates over the Zobrist hash and the packed moves and values of every state"""
+        for i in range(len(self)):
+            moves, values = self.actions(i)
+            yield int(self.keys[i]), dict(zip(moves.tolist(), values.tolist()))
+
+def write(path: str, table: Dict[int, Dict[int, float]], positions: Dict[int, str] = None) -> None:
+    """
+    Writes a Zobrist keyed table to a binary Q-Table file.
+
+    table: The packed moves and values of each state, keyed by Zobrist hash
+    positions: The FEN of each state, stored so the file can be converted back to JSON and used for training
+    """
+    keys = sorted(table)
+    offsets = np.zeros(len(keys) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(table[k]) for k in keys])
+    moves = np.fromiter((m for k in keys for m in table[k]), dtype='<u2', count=int(offsets[-1]))
+    values = np.fromiter((v for k in keys for v in table[k].values()), dtype='<f8', count=int(offsets[-1]))
+    arrays = [np.array(keys, dtype='<u8'), offsets, moves, values]
+    if positions is not None:
+        encoded = [positions[k].encode('ascii') for k in keys]
+        position_offsets = np.zeros(len(keys) + 1, dtype='<u8')
+        position_offsets[1:] = np.cumsum([len(p) for p in encoded])
+        arrays += [position_offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys), len(moves), positions is not None))
+        for array in arrays:
+            f.write(b"\0" * (_align(f.tell()) - f.tell())) # Pad to keep every array aligned
+            f.write(array.tobytes())
+
+def convert_from_json(json_path: str, binary_path: str) -> None:
+    """
+    Converts a FEN keyed JSON Q-Table (like qtable.json) to a binary Q-Table file.
+    FENs only differing in the move counters end up in the same state, where the last value of each action wins.
+    """
+    with open(json_path) as json_file:
+        data = json.load(json_file)
+    table, positions = {}, {}
+    for fen, actions in data.items():
+        key = zobrist_hash(Board(fen))
+        entry = table.setdefault(key, {})
+        for action, value in actions.items():
+            entry[pack_move(Move.from_uci(action))] = value
+        positions[key] = fen
+    write(binary_path, table, positions)
+
+def convert_to_json(binary_path: str, json_path: str) -> None:
+    """
+    Converts a binary Q-Table file with positions back to a FEN keyed JSON Q-Table.
+    """
+    file = BinaryQTable(binary_path)
+    data = {file.position(i): {unpack_move(m).uci(): v for m, v in actions.items()} for i, (_, actions) in enumerate(file.items())}
+    with open(json_path, 'w') as outfile:
+        json.dump(data, fp=outfile)
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print("Usage: python qtable_binary.py <input.json|input.qtb> <output.qtb|output.json>")
+        exit(1)
+    if sys.argv[1].endswith('.json'):
+        convert_from_json(sys.argv[1], sys.argv[2])
+    else:
+        convert_to_json(sys.argv[1], sys.argv[2])
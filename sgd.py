@@ -1,10 +1,10 @@
 
 # Stochastic Gradient Descent
 from typing import Sequence
-from node import Node
+from tensor import Tensor
 
 class SGD:
-  def __init__(self, parameters: Sequence[Node], learning_rate: float):
+  def __init__(self, parameters: Sequence[Tensor], learning_rate: float):
     self.parameters = parameters
     self.learning_rate = learning_rate
 
@@ -0,0 +1,183 @@
+import random
+from multiprocessing import Lock
+from multiprocessing.context import get_spawning_popen
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Sequence, Tuple
+import numpy as np
+from chess import Board, Move
+from chess.polyglot import zobrist_hash
+from chess_utils import pack_move
+from policy import Policy
+
+"""
+A Q-Table living in shared memory.
+
+The table is an open addressing hash table of (state, action) entries, so every process working on the same table
+reads the newest values and its updates are seen by all the others right away.
+The table is split into regions, each guarded by its own lock (lock striping). An entry is always stored in the region
+of its home slot, so writers only block each other when they hit the same region. Readers never take a lock.
+"""
+
+MIXER = np.uint64(0x9E3779B97F4A7C15) # Spreads the packed moves over the whole 64 bit range
+
+_locks: Dict[str, Sequence] = {} # The locks of each table, registered when a table is created or sent to a spawned process
+_memory: Dict[str, SharedMemory] = {} # The shared memory blocks this process is attached to
+
+class SharedQTable(Policy):
+    shared = True
+
+    def __init__(self, learning_rate = 0.1, discount_rate = 1.0, ε = 0.3, capacity:int = 1 << 18, stripes:int = 64) -> None:
+        """
+        learning_rate: Adjust how much the value is updated when new rewards are found
+        discount_rate: Adjust how much the next states expected value should influence the reward
+        ε: Control how often the table should be used. 0 = always, 1 = never
+        capacity: The maximal number of (state, action) entries, rounded up to a power of two
+        stripes: The number of regions with their own lock, rounded up to a power of two
+        """
+        self.learning_rate = learning_rate
+        self.discount_rate = discount_rate
+        self.ε = ε
+        self.capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.stripes = min(1 << max(stripes - 1, 1).bit_length(), self.capacity)
+
+        # States (8 bytes), moves (2 bytes, 0 marks an empty slot since a1a1 is never a move) and values (8 bytes)
+        memory = SharedMemory(create=True, size=self.capacity * 18)
+        memory.buf[:] = bytes(memory.size)
+        self.name = memory.name
+        self.owner = True # Only the creating process removes the shared memory again
+        _memory[self.name] = memory
+        _locks[self.name] = [Lock() for _ in range(self.stripes)]
+        self._attach()
+
+    def _attach(self) -> None:
+        """Creates the array views of the shared memory"""
+        buffer = _memory[self.name].buf
+        self.states = np.ndarray((self.capacity,), dtype=np.uint64, buffer=buffer, offset=0)
+        self.values = np.ndarray((self.capacity,), dtype=np.float64, buffer=buffer, offset=self.capacity * 8)
+        self.moves = np.ndarray((self.capacity,), dtype=np.uint16, buffer=buffer, offset=self.capacity * 16)
+        self.locks = _locks[self.name]
+        self.region_size = self.capacity // self.stripes
+
+    def __getstate__(self):
+        # Only pass on the name of the shared memory, so sending the table to another process doesn't copy it
+        state = {k: v for k, v in self.__dict__.items() if k not in ('states', 'values', 'moves', 'locks')}
+        state['owner'] = False
+        if get_spawning_popen() is not None:
+            state['locks'] = self.locks # Locks can only be passed on while spawning a process
+        return state
+
+    def __setstate__(self, state):
+        locks = state.pop('locks', None)
+        self.__dict__.update(state)
+        if locks is not None:
+            _locks[self.name] = locks
+        if self.name not in _memory:
+            _memory[self.name] = SharedMemory(name=self.name) # Attach once per process
+        assert self.name in _locks, "The table must be sent to the process while it is spawned, e.g. as a Pool initializer argument"
+        self._attach()
+
+    def close(self) -> None:
+        """Detaches from the shared memory, and removes it if this is the table that created it"""
+        self.states = self.values = self.moves = None # Release the views before closing the memory
+        memory = _memory.pop(self.name, None)
+        if memory is not None:
+            memory.close()
+            if self.owner:
+                memory.unlink()
+                _locks.pop(self.name, None)
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.moves))
+
+    def _homes(self, state: int, moves: np.ndarray) -> np.ndarray:
+        """The home slot of each (state, move) entry"""
+        mixed = np.uint64(state) ^ (moves.astype(np.uint64) * MIXER)
+        return ((mixed ^ (mixed >> np.uint64(29))) & np.uint64(self.capacity - 1)).astype(np.int64)
+
+    def _next(self, slots: np.ndarray) -> np.ndarray:
+        """The next slot to probe, wrapping around inside the region"""
+        start = slots - slots % self.region_size
+        return start + (slots + 1 - start) % self.region_size
+
+    def _find(self, state: int, moves: np.ndarray) -> np.ndarray:
+        """
+        Returns the slot of each (state, move) entry, or -1 for entries not in the table.
+        All moves are probed at once, only the moves that haven't found their slot yet continue probing.
+        """
+        slots = np.full(len(moves), -1, dtype=np.int64)
+        probes = self._homes(state, moves)
+        pending = np.arange(len(moves))
+        for _ in range(self.region_size):
+            if len(pending) == 0:
+                break
+            stored = self.moves[probes]
+            hit = (stored == moves[pending]) & (self.states[probes] == np.uint64(state))
+            slots[pending[hit]] = probes[hit]
+            keep = ~hit & (stored != 0) # Continue probing until we hit the entry or an empty slot
+            pending, probes = pending[keep], self._next(probes[keep])
+        return slots
+
+    def _lookup(self, state: int, moves: Sequence[Move]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the values of the moves, and whether each move is in the table"""
+        packed = np.array([pack_move(m) for m in moves], dtype=np.uint16)
+        slots = self._find(state, packed)
+        found = slots >= 0
+        return np.where(found, self.values[np.maximum(slots, 0)], 0.0), found
+
+    def pick_move(self, state: Board) -> Move:
+        moves = list(state.legal_moves)
+
+        # Roll dice to see if the look up table should be used, and check if the table has any of the actions
+        if random.uniform(0,1) > self.ε:
+            values, found = self._lookup(zobrist_hash(state), moves)
+            if found.any():
+                return moves[int(np.argmax(np.where(found, values, -np.inf)))]
+
+        # If we don't have the state or we didn't hit a high enough number by chance, then take a random action
+        return random.choice(moves)
+
+    def expected_reward(self, state: Board, action: Move) -> float:
+        return self.expected_rewards(state, [action])[0]
+
+    def expected_rewards(self, state: Board, actions: Sequence[Move]) -> Sequence[float]:
+        return self._lookup(zobrist_hash(state), actions)[0].tolist()
+
+    def _max(self, state: Board) -> float:
+        values, found = self._lookup(zobrist_hash(state), list(state.legal_moves))
+
+        # If we don't have the state, then early out
+        if not found.any():
+            return 0
+
+        return float(values[found].max()) # Find the max value for all actions in state
+
+    def update(self, state: Board, action: Move, reward: float, new_state: Board) -> None:
+        target = reward + self.discount_rate * self._max(new_state)
+        s = zobrist_hash(state)
+        a = pack_move(action)
+        home = int(self._homes(s, np.array([a], dtype=np.uint16))[0])
+
+        # Only one process at a time may change the region of the entry
+        with self.locks[home // self.region_size]:
+            slot = home
+            for _ in range(self.region_size):
+                if self.moves[slot] == 0: # Make sure the state and action is in the table
+                    self.states[slot] = s
+                    self.values[slot] = 0
+                    self.moves[slot] = a # Written last, since it marks the slot as used for the readers
+                    break
+                if self.moves[slot] == a and self.states[slot] == s:
+                    break
+                slot = int(self._next(np.array([slot]))[0])
+            else:
+                raise MemoryError("The region of the shared Q-Table is full, increase the capacity")
+
+            # Update the value for state->action, like the QTable does
+            self.values[slot] += self.learning_rate * (target - self.values[slot])
+
+    def to_table(self) -> Dict[int, Dict[int, float]]:
+        """Copies the entries into a Zobrist keyed table, like the one of a ZobristQTable"""
+        table = {}
+        for slot in np.flatnonzero(self.moves):
+            table.setdefault(int(self.states[slot]), {})[int(self.moves[slot])] = float(self.values[slot])
+        return table
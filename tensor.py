@@ -0,0 +1,178 @@
+from __future__ import annotations
+from typing import Callable, Sequence, Union
+import numpy as np
+
+from node import Node, topological_order
+
+"""
+A NumPy backed autograd engine.
+
+A Tensor works like a Node, but holds a whole array of values instead of a single scalar.
+That way a layer only has to create a handful of objects per forward pass instead of one per multiplication.
+"""
+
+def _unbroadcast(grad: np.ndarray, shape: tuple) -> np.ndarray:
+    """Sums the gradient over the axes that were broadcasted in the forward pass"""
+    while grad.ndim > len(shape):
+        grad = grad.sum(axis=0)
+    for axis, size in enumerate(shape):
+        if size == 1 and grad.shape[axis] != 1:
+            grad = grad.sum(axis=axis, keepdims=True)
+    return grad
+
+class Tensor:
+    def __init__(self, value, parents: Sequence[tuple[Tensor, Callable[[np.ndarray], np.ndarray]]] = None):
+        """
+        value: The array (or scalar) held by the tensor
+        parents: Pairs of parent tensors and a function mapping the upstream gradient to the parent gradient
+        """
+        self.value = np.asarray(value, dtype=np.float64)
+        self.grad = np.zeros_like(self.value)
+        if parents is None:
+            parents = []
+        self.parents = parents
+
+    def nullify_gradient(self):
+        self.grad = np.zeros_like(self.value)
+
+    def __repr__(self):
+        return "Tensor (shape=%s, value=%s)" % (self.shape, self.value)
+
+    @property
+    def shape(self) -> tuple:
+        return self.value.shape
+
+    def __len__(self) -> int:
+        return len(self.value)
+
+    def backward(self, release_graph: bool = False):
+        """
+        Computes the gradient of every (upstream) tensor in the computational graph w.r.t. tensor.
+
+        release_graph: Drop the parents of every visited tensor afterwards, so the graph can be reclaimed
+        """
+        grads = {id(self): np.ones_like(self.value)} # The gradient of a tensor w.r.t. itself is 1 by definition.
+        for tensor in topological_order(self):
+            df = grads.pop(id(tensor), None)
+            if df is not None:
+                tensor.grad = tensor.grad + df
+                for parent, backward_fn in tensor.parents:
+                    g = backward_fn(df)
+                    grads[id(parent)] = grads[id(parent)] + g if id(parent) in grads else g
+            if release_graph:
+                tensor.parents = []
+
+    def __add__(self, other):
+        other = as_tensor(other)
+        return Tensor(self.value + other.value, [
+            (self, lambda df: _unbroadcast(df, self.shape)),
+            (other, lambda df: _unbroadcast(df, other.shape))])
+
+    def __mul__(self, other):
+        other = as_tensor(other)
+        return Tensor(self.value * other.value, [
+            (self, lambda df: _unbroadcast(df * other.value, self.shape)),
+            (other, lambda df: _unbroadcast(df * self.value, other.shape))])
+
+    def __matmul__(self, other):
+        other = as_tensor(other)
+        a, b = self.value, other.value
+        def grad_a(df):
+            if b.ndim == 1:
+                return np.multiply.outer(df, b) # Covers both a vector (df is a scalar) and a matrix
+            return b @ df if a.ndim == 1 else df @ b.T
+        def grad_b(df):
+            if a.ndim == 1:
+                return np.multiply.outer(a, df)
+            return a.T @ df
+        return Tensor(a @ b, [(self, grad_a), (other, grad_b)])
+
+    def __pow__(self, power: Union[float, int]):
+        assert type(power) in {float, int}, "power must be float or int"
+        return Tensor(self.value ** power, [(self, lambda df: df * power * self.value ** (power - 1))])
+
+    def __neg__(self):
+        return self * -1.0
+
+    def __sub__(self, other):
+        return self + (-as_tensor(other))
+
+    def __truediv__(self, other):
+        return self * as_tensor(other) ** -1
+
+    def __radd__(self, other):
+        return as_tensor(other) + self
+
+    def __rmul__(self, other):
+        return as_tensor(other) * self
+
+    def __rsub__(self, other):
+        return as_tensor(other) - self
+
+    def __rtruediv__(self, other):
+        return as_tensor(other) / self
+
+    def __getitem__(self, index):
+        def backward_fn(df):
+            grad = np.zeros_like(self.value)
+            np.add.at(grad, index, df) # Indices may repeat, so we have to accumulate
+            return grad
+        return Tensor(self.value[index], [(self, backward_fn)])
+
+    def reshape(self, *shape):
+        return Tensor(self.value.reshape(*shape), [(self, lambda df: df.reshape(self.shape))])
+
+    def sum(self, axis=None, keepdims=False):
+        def backward_fn(df):
+            if axis is not None and not keepdims:
+                df = np.expand_dims(df, axis)
+            return np.broadcast_to(df, self.shape).copy()
+        return Tensor(self.value.sum(axis=axis, keepdims=keepdims), [(self, backward_fn)])
+
+    def mean(self, axis=None, keepdims=False):
+        count = self.value.size if axis is None else np.prod([self.shape[a] for a in np.atleast_1d(axis)])
+        return self.sum(axis=axis, keepdims=keepdims) / float(count)
+
+    def maximum(self, other):
+        other = as_tensor(other)
+        mask = self.value >= other.value # Ties are routed to self
+        return Tensor(np.where(mask, self.value, other.value), [
+            (self, lambda df: _unbroadcast(df * mask, self.shape)),
+            (other, lambda df: _unbroadcast(df * ~mask, other.shape))])
+
+    def tanh(self):
+        t = np.tanh(self.value)
+        return Tensor(t, [(self, lambda df: df * (1 - t ** 2))])
+
+    def relu(self):
+        mask = self.value > 0.0
+        return Tensor(self.value * mask, [(self, lambda df: df * mask)])
+
+    def exp(self):
+        e = np.exp(self.value)
+        return Tensor(e, [(self, lambda df: df * e)])
+
+def as_tensor(values) -> Tensor:
+    """
+    Wraps values in a tensor without any parents.
+    Accepts a tensor (returned as is), a number, an array or a (nested) sequence of Nodes.
+    """
+    if isinstance(values, Tensor):
+        return values
+    if isinstance(values, Node):
+        return Tensor(values.value)
+    if isinstance(values, (int, float, np.ndarray, np.number)):
+        return Tensor(values)
+    return Tensor(np.array([as_tensor(v).value for v in values]))
+
+def ReLU(x:Tensor) -> Tensor:
+    return x.relu()
+
+def Tanh(x:Tensor) -> Tensor:
+    return x.tanh()
+
+# The derivative of each known activation expressed by its output, so layers can fuse the activation into their own backward pass
+ACTIVATION_DERIVATIVES = {
+    ReLU: lambda out: out > 0.0,
+    Tanh: lambda out: 1 - out ** 2,
+}
@@ -1,60 +1,183 @@
 from __future__ import annotations
-from typing import Sequence
+from typing import Dict, Iterator, List, Sequence, Tuple
+import numpy as np
 import chess
+from chess.polyglot import zobrist_hash
 
 class TreeNode:
-    def __init__(self, state: chess.Board, action: chess.Move = None, parent: TreeNode = None):
-        self.state:chess.Board = state
-        self.actions:Sequence[chess.Move] = [m for m in state.legal_moves]
+    # A search can hold hundreds of thousands of nodes, so a node only keeps the moves to its children and where its statistics are.
+    # The position of a node isn't stored, the search rebuilds it by pushing the moves from the root onto a board.
+    __slots__ = ('action', 'index', 'outcome', 'actions', 'priors', 'children', 'child_index')
+
+    def __init__(self, action: chess.Move = None, index: int = 0, outcome: chess.Outcome = None):
+        """
+        action: The move from the (first) parent
+        index: The index of the statistics of the node in the TreeStats of the search
+        outcome: The outcome of the game if it is over in the position of the node, checked once when the node is created
+        """
         self.action:chess.Move = action
-        self.parent:TreeNode = parent
-        self.result = 0
-        self.explored = 0
-        self.childNodes = dict[chess.Move, TreeNode]()
-
-    def update_result(self, q: float):
-        self.result += q
-        #self.explored += 1
-    
-    def append_exploration(self):
-        v = self
-        while True:
-            v.explored += 1
-            if v.parent is None:
-                break
-            v = v.parent
-
-    def explore(self) -> TreeNode:
-        action = None
-        for move in self.actions:
-            if move not in self.childNodes.keys():
-                action = move
-                break
-        board = chess.Board(self.state.fen())
+        self.index = index
+        self.outcome = outcome
+        self.actions:List[chess.Move] = None # The legal moves, listed the first time the node is explored
+        self.priors:np.ndarray = None # The heuristic value of each action, evaluated once when the actions are listed
+        self.children:List[TreeNode] = [] # The child of actions[i] is children[i], since actions are explored in order
+        self.child_index:np.ndarray = None # The statistics index of each child, to look up the statistics of all children at once
+
+    def open(self, actions: Sequence[chess.Move], priors: Sequence[float]):
+        "Lists the legal moves of the node and their heuristic values"
+        self.actions = list(actions)
+        self.priors = np.asarray(priors, dtype=float)
+        self.child_index = np.empty(len(self.actions), dtype=np.int64)
+
+    def explore(self, board: chess.Board, stats: TreeStats, table: TranspositionTable = None) -> Tuple[chess.Move, TreeNode]:
+        """
+        Adds the child of the next unexplored action, and returns the action and the child. The node must be opened first.
+        board: The position of this node, it is left unchanged
+        stats: The statistics of the search, where a new child gets its entry
+        table: Share the node of the position if another path already reached it, which turns the tree into a DAG
+        """
+        action = self.actions[len(self.children)]
+        child = None
         board.push(action)
-        self.childNodes[action] = TreeNode(board, action, self)
-        return self.childNodes[action]
+        if table is not None:
+            key = zobrist_hash(board)
+            child = table.get(key)
+        if child is None:
+            # Repetitions depend on the moves before the position, so a shared node keeps the outcome of the first path to it
+            child = TreeNode(action, stats.add(), board.outcome())
+            if table is not None:
+                table.add(key, child)
+        board.pop()
+        self.child_index[len(self.children)] = child.index
+        self.children.append(child)
+        return action, child
 
-    def get_average(self) -> float:
-        return self.result / self.explored
+    def is_terminal(self) -> bool:
+        return self.outcome is not None
 
-    def get_explores(self) -> int:
-        return self.explored
-    
     def get_unexplored(self) -> int:
-        return len(self.actions) - len(self.childNodes)
+        return len(self.actions) - len(self.children) if self.actions is not None else None
 
     def fully_explored(self) -> bool:
-        return len(self.actions) == len(self.childNodes)
+        return self.actions is not None and len(self.actions) == len(self.children)
 
     def get_actions(self) -> Sequence[chess.Move]:
-        return self.childNodes.keys()
+        return self.actions[:len(self.children)] if self.actions is not None else []
 
     def get_child(self, action:chess.Move) -> TreeNode:
-        return self.childNodes[action]
+        return self.children[self.actions.index(action)]
+
+    def get_children(self) -> Iterator[Tuple[chess.Move, TreeNode]]:
+        return zip(self.actions or [], self.children)
+
+    def get_child_index(self) -> np.ndarray:
+        return self.child_index[:len(self.children)]
+
+    def get_priors(self) -> np.ndarray:
+        return self.priors[:len(self.children)]
 
     def count_children(self) -> int:
-        return len(self.childNodes)
+        return len(self.children)
+
+class TreeStats:
+    def __init__(self, capacity:int = 1 << 10) -> None:
+        """
+        The visits and total rewards of all the nodes of a search, kept in arrays indexed by TreeNode.index.
+        capacity: The initial number of nodes, the arrays double in size when they run full
+        """
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.results = np.zeros(capacity)
+        self.proven = np.zeros(capacity, dtype=np.int8) # 1 if white is proven to win from the node, -1 for black, 0 if unknown
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self) -> int:
+        "Returns the index of a new node"
+        if self.size == len(self.visits):
+            self.visits = np.concatenate((self.visits, np.zeros_like(self.visits)))
+            self.results = np.concatenate((self.results, np.zeros_like(self.results)))
+            self.proven = np.concatenate((self.proven, np.zeros_like(self.proven)))
+        self.size += 1
+        return self.size - 1
+
+    def count_exploration(self, indices: Sequence[int]):
+        self.visits[indices] += 1
+
+    def apply_virtual_loss(self, indices: Sequence[int], loss: int):
+        "Counts lost visits for a playout in flight, which steers the selection of other playouts away from the path"
+        self.visits[indices] += loss
+
+    def revert_virtual_loss(self, indices: Sequence[int], loss: int):
+        self.visits[indices] -= loss
+
+    def update_result(self, indices: Sequence[int], q: float):
+        self.results[indices] += q
+
+    def get_explores(self, index: int) -> int:
+        return int(self.visits[index])
+
+    def get_average(self, index: int) -> float:
+        return self.results[index] / self.visits[index]
+
+    def prove(self, index: int, winner: chess.Color):
+        self.proven[index] = 1 if winner == chess.WHITE else -1
+
+    def get_proven(self, index: int) -> chess.Color:
+        "The side that is proven to win from the node, or None if it isn't proven"
+        return None if self.proven[index] == 0 else self.proven[index] == 1
+
+    def compact(self, root: TreeNode) -> None:
+        "Keeps only the statistics of the nodes that can be reached from the root, and renumbers the nodes"
+        nodes = [root]
+        seen = {id(root)}
+        for v in nodes: # The list grows while it is walked
+            for child in v.children:
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    nodes.append(child)
+        old = np.array([v.index for v in nodes], dtype=np.int64)
+        renumber = np.empty(self.size, dtype=np.int64)
+        renumber[old] = np.arange(len(nodes))
+        self.visits = np.concatenate((self.visits[old], np.zeros(len(nodes), dtype=np.int64)))
+        self.results = np.concatenate((self.results[old], np.zeros(len(nodes))))
+        self.proven = np.concatenate((self.proven[old], np.zeros(len(nodes), dtype=np.int8)))
+        self.size = len(nodes)
+        for i, v in enumerate(nodes):
+            v.index = i
+            if v.child_index is not None:
+                v.child_index[:len(v.children)] = renumber[v.get_child_index()]
+
+class TranspositionTable:
+    def __init__(self, capacity:int = 1 << 20) -> None:
+        """
+        The nodes of the search keyed by the Zobrist hash of their position, so transpositions share a node.
+        capacity: The maximal number of positions to store. Positions found after that get nodes of their own.
+        """
+        self.capacity = capacity
+        self.nodes:Dict[int, TreeNode] = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, key:int) -> TreeNode:
+        return self.nodes.get(key)
+
+    def add(self, key:int, node:TreeNode) -> None:
+        if len(self.nodes) < self.capacity:
+            self.nodes[key] = node
+
+    def clear(self) -> None:
+        self.nodes.clear()
 
-    def get_state(self) -> chess.Board:
-        return self.state
+    def retain(self, root:TreeNode) -> None:
+        "Drops the nodes that can't be reached from the root anymore, so the rest of an old tree can be released"
+        reachable = {id(root)}
+        pending = [root]
+        while pending:
+            for child in pending.pop().children:
+                if id(child) not in reachable:
+                    reachable.add(id(child))
+                    pending.append(child)
+        self.nodes = {k: v for k, v in self.nodes.items() if id(v) in reachable}